@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+'''
+Synthetic clusters for the `pylighthouse` benchmarks.
+
+Run with ``make bench`` or ``py.test benchmarks``. The shape of the cluster
+is controlled with the command line options below; the same seed always
+generates the same cluster and workloads.
+'''
+
+import random
+
+import pytest
+
+import pylighthouse.pylighthouse as lighthouse
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("pylighthouse synthetic cluster")
+    group.addoption("--nodes", type=int, default=1000,
+                    help="number of nodes in the cluster")
+    group.addoption("--loads", type=int, default=2000,
+                    help="number of workloads to place")
+    group.addoption("--resource-keys", type=int, default=10,
+                    help="number of distinct resources")
+    group.addoption("--tag-density", type=float, default=0.1,
+                    help="fraction of nodes carrying a tag")
+    group.addoption("--ward-density", type=float, default=0.1,
+                    help="fraction of nodes carrying a ward")
+    group.addoption("--aversion-groups", type=int, default=20,
+                    help="number of aversion groups workloads spread over")
+    group.addoption("--load-size", type=float, default=0.05,
+                    help="mean workload requirement, as a fraction of "
+                    "mean node capacity")
+    group.addoption("--seed", type=int, default=987)
+
+
+class Cluster(object):
+    '''
+    Recipe for a reproducible synthetic cluster. ``nodes()`` and
+    ``loads()`` build fresh objects on every call, since placement
+    mutates them.
+    '''
+
+    def __init__(self, nodes, loads, resource_keys, tag_density,
+                 ward_density, aversion_groups, load_size, seed):
+        rng = random.Random(seed)
+        self.keys = ["resource-%d" % i for i in range(resource_keys)]
+        self.rubric = dict((k, rng.uniform(0.5, 2)) for k in self.keys)
+        self.node_dicts = []
+        for i in range(nodes):
+            resources = dict((k, rng.randint(50, 150)) for k in self.keys)
+            if rng.random() < tag_density:
+                resources["tag"] = 0
+            if rng.random() < ward_density:
+                resources["ward"] = -float("inf")
+            self.node_dicts.append({
+                "name": "node-%06d" % i,
+                "resources": resources
+            })
+        self.load_dicts = []
+        for i in range(loads):
+            used = rng.sample(self.keys, rng.randint(1, len(self.keys)))
+            requirements = dict(
+                (k, rng.expovariate(1 / (100 * load_size))) for k in used)
+            if rng.random() < tag_density:
+                requirements["tag"] = 0
+            d = {
+                "name": "load-%07d" % i,
+                "requirements": requirements
+            }
+            if rng.random() < ward_density:
+                d["immunities"] = ["ward"]
+            if aversion_groups:
+                d["aversion_groups"] = [
+                    "group-%d" % rng.randrange(aversion_groups)]
+            self.load_dicts.append(d)
+
+    def nodes(self):
+        return lighthouse.Node.from_list(
+            [dict(d, resources=dict(d["resources"]))
+             for d in self.node_dicts])
+
+    def loads(self):
+        return lighthouse.Workload.from_list(self.load_dicts)
+
+
+@pytest.fixture(scope="session")
+def cluster(request):
+    option = request.config.getoption
+    return Cluster(option("--nodes"), option("--loads"),
+                   option("--resource-keys"), option("--tag-density"),
+                   option("--ward-density"), option("--aversion-groups"),
+                   option("--load-size"), option("--seed"))
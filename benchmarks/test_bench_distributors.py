@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+'''
+Benchmarks for placing workloads with `pylighthouse` distributors.
+'''
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import pylighthouse.pylighthouse as lighthouse
+
+DISTRIBUTORS = {
+    "prioritized": lambda c, ns: lighthouse.PrioritizedDistributor(ns),
+    "roundrobin": lambda c, ns: lighthouse.RoundRobinDistributor(ns),
+    "binpack": lambda c, ns: lighthouse.BinPackDistributor.from_list(
+        c.rubric, ns),
+    "binpack-capacity": lambda c, ns: lighthouse.BinPackDistributor.from_list(
+        c.rubric, ns).use_capacity_index(),
+    "vector-binpack": lambda c, ns:
+        lighthouse.VectorBinPackDistributor.from_list(c.rubric, ns),
+}
+
+
+@pytest.mark.parametrize("kind", sorted(DISTRIBUTORS))
+def test_attempt_assign_loads(benchmark, cluster, kind):
+    def setup():
+        distor = DISTRIBUTORS[kind](cluster, cluster.nodes())
+        return (distor, cluster.loads()), {}
+
+    benchmark.pedantic(lambda d, ls: d.attempt_assign_loads(ls),
+                       setup=setup, rounds=3)
+
+
+@pytest.mark.parametrize("kind", ["prioritized", "binpack"])
+def test_attempt_assign_loads_matrix(benchmark, cluster, kind):
+    pytest.importorskip("numpy")
+
+    def setup():
+        distor = DISTRIBUTORS[kind](cluster, cluster.nodes()).use_matrix()
+        return (distor, cluster.loads()), {}
+
+    benchmark.pedantic(lambda d, ls: d.attempt_assign_loads(ls),
+                       setup=setup, rounds=3)
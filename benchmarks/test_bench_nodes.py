@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+'''
+Benchmarks for `pylighthouse` nodes and rubrics.
+'''
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import pylighthouse.pylighthouse as lighthouse
+
+
+def test_attempt_attach(benchmark, cluster):
+    def setup():
+        return (cluster.nodes(), cluster.loads()), {}
+
+    def attach(nodes, loads):
+        for n, l in zip(nodes, loads):
+            n.attempt_attach(l)
+
+    benchmark.pedantic(attach, setup=setup, rounds=5)
+
+
+def test_detach_all(benchmark, cluster):
+    def setup():
+        nodes = cluster.nodes()
+        distor = lighthouse.PrioritizedDistributor(nodes)
+        distor.attempt_assign_loads(cluster.loads())
+        return (nodes,), {}
+
+    def detach(nodes):
+        for n in nodes:
+            n.detach_all()
+
+    benchmark.pedantic(detach, setup=setup, rounds=3)
+
+
+def test_rubric_score(benchmark, cluster):
+    rubric = lighthouse.Rubric(cluster.rubric)
+    parts = [n.resources for n in cluster.nodes()] + \
+        [l.requirements for l in cluster.loads()]
+
+    def score():
+        for p in parts:
+            rubric.score(p)
+
+    benchmark(score)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""asyncio front end for distributors, imported through
+``pylighthouse.aio``. Uses syntax that only Python 3.7 and later parse."""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDistributor(object):
+    '''
+    Wraps a distributor for use from asyncio code.
+
+    Workloads submitted through ``assign`` within ``window`` seconds of the
+    first one are placed together in one ``attempt_assign_loads`` call,
+    made on a single worker thread so the event loop is never blocked and
+    the distributor only ever has one writer. A batch is sent early once
+    it holds ``max_batch`` workloads.
+    '''
+
+    def __init__(self, distributor, window=0.002, max_batch=4096):
+        self.distributor = distributor
+        self.window = window
+        self.max_batch = max_batch
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+        self._timer = None
+
+    async def assign(self, load):
+        '''
+        Place one workload, returning the name of its node or None.
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((load, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush(loop)
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush, loop)
+        return await future
+
+    async def assign_loads(self, loads):
+        '''
+        Place several workloads, returning a dictionary like
+        ``attempt_assign_loads`` does.
+        '''
+        names = await asyncio.gather(*[self.assign(l) for l in loads])
+        return dict(zip([l.name for l in loads], names))
+
+    async def release(self, names):
+        '''
+        Release workloads through the distributor's writer thread.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer,
+                                          self.distributor.release,
+                                          list(names))
+
+    def _flush(self, loop):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        placed = loop.run_in_executor(
+            self._writer, self.distributor.attempt_assign_loads,
+            [load for load, future in batch])
+        placed.add_done_callback(lambda done: self._settle(batch, done))
+
+    @staticmethod
+    def _settle(batch, done):
+        error = done.exception()
+        results = None if error is not None else done.result()
+        for load, future in batch:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results[load.name])
+
+    def close(self):
+        '''
+        Stop the writer thread once the batches already sent are placed.
+        '''
+        self._writer.shutdown(wait=True)
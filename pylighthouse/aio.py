@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""asyncio front end for distributors. Requires Python 3.7 or later."""
+
+import sys
+
+# The front end itself is kept in another module, which older Pythons
+# cannot even parse, so that importing this one fails plainly on them
+if sys.version_info < (3, 7):
+    raise ImportError("pylighthouse.aio requires Python 3.7 or later")
+
+from pylighthouse._aio import AsyncDistributor  # noqa: E402,F401
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""Memory-compact nodes and workloads."""
+
+from array import array
+from bisect import bisect_left
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from pylighthouse.pylighthouse import DEFAULT_SCHEMA, Workload, _BaseNode, \
+    _BaseWorkload
+
+
+class ResourceVector(MutableMapping):
+    '''
+    Mapping of resource names to quantities, stored as a sorted array of
+    the names' indices in a shared ``ResourceSchema`` alongside an array of
+    doubles, one for each name present. Its size follows the names it
+    holds, not how many names the schema has interned. Quantities are
+    stored as doubles; a bitmask over their positions marks those which
+    were integers, so that they come back as integers.
+    '''
+
+    __slots__ = ('schema', 'indices', 'values', 'ints')
+
+    def __init__(self, items=(), schema=DEFAULT_SCHEMA):
+        self.schema = schema
+        if hasattr(items, 'items'):
+            items = items.items()
+        # Fill the arrays in one allocation each rather than key by key
+        pairs = sorted(dict((schema.intern(k), v) for k, v in items).items())
+        self.indices = array('I', [i for i, v in pairs])
+        self.values = array('d', [v for i, v in pairs])
+        ints = 0
+        for at, (i, v) in enumerate(pairs):
+            if isinstance(v, int):
+                ints |= 1 << at
+        self.ints = ints
+
+    # Position of the named resource in the arrays, or None
+    def _find(self, key):
+        i = self.schema.indices.get(key)
+        if i is None:
+            return None
+        at = bisect_left(self.indices, i)
+        if at < len(self.indices) and self.indices[at] == i:
+            return at
+        return None
+
+    def __getitem__(self, key):
+        at = self._find(key)
+        if at is None:
+            raise KeyError(key)
+        if (self.ints >> at) & 1:
+            return int(self.values[at])
+        return self.values[at]
+
+    def __setitem__(self, key, value):
+        at = self._find(key)
+        if at is None:
+            i = self.schema.intern(key)
+            at = bisect_left(self.indices, i)
+            self.indices.insert(at, i)
+            self.values.insert(at, value)
+            # Make room for the new position's bit
+            low = self.ints & ((1 << at) - 1)
+            self.ints = low | ((self.ints >> at) << (at + 1))
+        else:
+            self.values[at] = value
+        if isinstance(value, int):
+            self.ints |= 1 << at
+        else:
+            self.ints &= ~(1 << at)
+
+    def __delitem__(self, key):
+        at = self._find(key)
+        if at is None:
+            raise KeyError(key)
+        del self.indices[at]
+        del self.values[at]
+        low = self.ints & ((1 << at) - 1)
+        self.ints = low | ((self.ints >> (at + 1)) << at)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __iter__(self):
+        names = self.schema.names
+        for i in self.indices:
+            yield names[i]
+
+    def __len__(self):
+        return len(self.indices)
+
+    # Changes whenever the quantities do, for workloads to tell whether
+    # their compiled plan still holds
+    def _fingerprint(self):
+        return (self.indices.tobytes(), self.ints, self.values.tobytes())
+
+    def __str__(self):
+        return str(dict(self))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class CompactWorkload(_BaseWorkload):
+    __slots__ = ('name', 'requirements', 'immunities', 'aversion_groups',
+                 '_plan')
+
+    def __init__(self, name, requirements, immunities=None,
+                 aversion_groups=None, schema=DEFAULT_SCHEMA):
+        if not isinstance(requirements, ResourceVector):
+            requirements = ResourceVector(requirements, schema)
+        super(CompactWorkload, self).__init__(name, requirements,
+                                              immunities, aversion_groups)
+
+    def _state(self):
+        return {
+            'name': self.name,
+            'requirements': self.requirements,
+            'immunities': self.immunities,
+            'aversion_groups': self.aversion_groups
+        }
+
+    @staticmethod
+    def from_list(ds, schema=DEFAULT_SCHEMA):
+        return [CompactWorkload.from_dict(d, schema) for d in ds]
+
+    @staticmethod
+    def from_dict(d, schema=DEFAULT_SCHEMA):
+        w = Workload.from_dict(d)
+        return CompactWorkload(w.name, w.requirements, w.immunities,
+                               w.aversion_groups, schema)
+
+
+class CompactNode(_BaseNode):
+    __slots__ = ('name', 'resources', 'assigned_workloads', '_aversions',
+                 '_watchers', '_mutex', '_wards')
+
+    def __init__(self, name, resources, assigned_workloads=None,
+                 schema=DEFAULT_SCHEMA):
+        if not isinstance(resources, ResourceVector):
+            resources = ResourceVector(resources, schema)
+        super(CompactNode, self).__init__(name, resources,
+                                          assigned_workloads)
+
+    def _state(self):
+        return {
+            'name': self.name,
+            'resources': self.resources,
+            'assigned_workloads': self.assigned_workloads
+        }
+
+    @staticmethod
+    def from_list(ns, schema=DEFAULT_SCHEMA):
+        return [CompactNode.from_dict(n, schema) for n in ns]
+
+    @staticmethod
+    def from_dict(d, schema=DEFAULT_SCHEMA):
+        return CompactNode(d['name'], d['resources'],
+                           d.get('assigned_workloads'), schema)
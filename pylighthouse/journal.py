@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""Append-only journal of changes to a distributor's nodes. Requires
+Python 3."""
+
+import os
+import struct
+import weakref
+import zlib
+
+from pylighthouse.compact import CompactNode, CompactWorkload, ResourceVector
+from pylighthouse.pylighthouse import Distributor, LighthouseException, \
+    Node, Workload
+
+MAGIC = b'PLHJRNL\x00'
+VERSION = 1
+
+# Magic, version, and the length of the token of the snapshot the journal
+# follows, which comes next
+_HEADER = struct.Struct('<8sQH')
+# Payload length, CRC-32 of the kind and payload, and kind of each record
+_RECORD = struct.Struct('<IIB')
+
+ATTACH = 1
+DETACH = 2
+RESOURCES = 3
+PLACED = 4
+ADDED = 5
+REMOVED = 6
+RECALLED = 7
+
+_U32 = struct.Struct('<I')
+_QUANTITY = struct.Struct('<dB')
+_MEMO = struct.Struct('<Bd')
+_FLAG = struct.Struct('<B')
+
+
+def _string(out, s):
+    data = s.encode('utf-8')
+    out += _U32.pack(len(data))
+    out += data
+
+
+def _names(out, names):
+    names = list(names)
+    out += _U32.pack(len(names))
+    for n in names:
+        _string(out, n)
+
+
+def _quantities(out, mapping):
+    out += _U32.pack(len(mapping))
+    for k, v in mapping.items():
+        _string(out, k)
+        out += _QUANTITY.pack(v, isinstance(v, int) and float(v) == v)
+
+
+def _workload(out, load):
+    _string(out, load.name)
+    _quantities(out, load.requirements)
+    _names(out, load.immunities)
+    _names(out, load.aversion_groups)
+
+
+class _Reader(object):
+    '''
+    Reads the fields of one record's payload in order.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+        self.at = 0
+
+    def _unpack(self, fmt):
+        values = fmt.unpack_from(self.data, self.at)
+        self.at += fmt.size
+        return values
+
+    def count(self):
+        return self._unpack(_U32)[0]
+
+    def string(self):
+        size = self.count()
+        s = self.data[self.at:self.at + size].decode('utf-8')
+        self.at += size
+        return s
+
+    def names(self):
+        return [self.string() for i in range(self.count())]
+
+    def quantities(self):
+        result = {}
+        for i in range(self.count()):
+            k = self.string()
+            v, is_int = self._unpack(_QUANTITY)
+            result[k] = int(v) if is_int else v
+        return result
+
+    def memo(self):
+        kind, value = self._unpack(_MEMO)
+        if kind == 0:
+            return None
+        return int(value) if kind == 1 else value
+
+    def workload(self, compact):
+        name = self.string()
+        requirements = self.quantities()
+        immunities = self.names()
+        groups = self.names()
+        if compact:
+            return CompactWorkload._assemble(
+                name, ResourceVector(requirements), immunities, groups)
+        return Workload._assemble(name, requirements, immunities, groups)
+
+
+def _read_header(f):
+    head = f.read(_HEADER.size)
+    if len(head) < _HEADER.size:
+        raise LighthouseException("Not a pylighthouse journal")
+    magic, version, size = _HEADER.unpack(head)
+    if magic != MAGIC:
+        raise LighthouseException("Not a pylighthouse journal")
+    if version != VERSION:
+        raise LighthouseException(
+            "Unsupported journal version {0}".format(version))
+    token = f.read(size).decode('utf-8') or None
+    return token
+
+
+# Yields (kind, payload) for each whole record, stopping at the first one
+# which was torn or corrupted by a crash while it was being written
+def _records(f):
+    while True:
+        head = f.read(_RECORD.size)
+        if len(head) < _RECORD.size:
+            return
+        size, crc, kind = _RECORD.unpack(head)
+        payload = f.read(size)
+        if len(payload) < size or \
+                zlib.crc32(bytes([kind]) + payload) & 0xffffffff != crc:
+            return
+        yield kind, payload
+
+
+class Journal(object):
+    '''
+    Write-ahead journal of the changes made to a distributor's nodes and
+    placements, framed as checksummed binary records. Records are buffered
+    and written, then synced to disk, ``batch`` at a time, or when ``sync``
+    is called; a crash loses at most the records not yet synced.
+
+    The journal is tied to the snapshot it follows by that snapshot's
+    token. Opening a journal which already follows the same snapshot
+    appends to it; otherwise it is started afresh.
+    '''
+
+    def __init__(self, path, token=None, batch=256):
+        self.path = path
+        self.batch = batch
+        self.pending = 0
+        self.buffer = bytearray()
+        self.file = None
+        end = None
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                try:
+                    if _read_header(f) == token:
+                        for record in _records(f):
+                            pass
+                        end = f.tell()
+                except LighthouseException:
+                    pass
+        if end is None:
+            self.restart(token)
+        else:
+            self.file = open(path, 'r+b')
+            # Drop any record torn by a crash before appending
+            self.file.truncate(end)
+            self.file.seek(end)
+        self._finalizer = weakref.finalize(self, _close, self.file,
+                                           self.buffer)
+
+    # Starts the journal again, empty, following the given snapshot
+    def restart(self, token):
+        if self.file is not None:
+            self.buffer[:] = b''
+            self.pending = 0
+            self.file.seek(0)
+            self.file.truncate()
+        else:
+            self.file = open(self.path, 'w+b')
+        data = (token or '').encode('utf-8')
+        self.file.write(_HEADER.pack(MAGIC, VERSION, len(data)) + data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _append(self, kind, payload):
+        payload = bytes(payload)
+        crc = zlib.crc32(bytes([kind]) + payload) & 0xffffffff
+        self.buffer += _RECORD.pack(len(payload), crc, kind)
+        self.buffer += payload
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.sync()
+
+    def sync(self):
+        '''
+        Write and sync every buffered record to disk.
+        '''
+        _flush(self.file, self.buffer)
+        self.pending = 0
+
+    def close(self):
+        self._finalizer()
+
+    def attached(self, node, load):
+        out = bytearray()
+        _string(out, node.name)
+        _workload(out, load)
+        self._append(ATTACH, out)
+
+    def detached(self, node, loads):
+        out = bytearray()
+        _string(out, node.name)
+        _names(out, (l.name for l in loads))
+        self._append(DETACH, out)
+
+    def changed(self, node):
+        out = bytearray()
+        _string(out, node.name)
+        _quantities(out, node.resources)
+        self._append(RESOURCES, out)
+
+    def placed(self, node, load):
+        out = bytearray()
+        _string(out, node.name)
+        _string(out, load.name)
+        self._append(PLACED, out)
+
+    def added(self, node):
+        out = bytearray([isinstance(node, CompactNode)])
+        _string(out, node.name)
+        _quantities(out, node.resources)
+        out += _U32.pack(len(node.assigned_workloads))
+        for load in node.assigned_workloads.values():
+            _workload(out, load)
+        self._append(ADDED, out)
+
+    def removed(self, node):
+        out = bytearray()
+        _string(out, node.name)
+        self._append(REMOVED, out)
+
+    def recalled(self, node, memo):
+        out = bytearray()
+        _string(out, node.name)
+        if memo is None:
+            out += _MEMO.pack(0, 0)
+        else:
+            out += _MEMO.pack(1 if isinstance(memo, int) else 2, memo)
+        self._append(RECALLED, out)
+
+
+def _flush(f, buffer):
+    if buffer and not f.closed:
+        f.write(buffer)
+        f.flush()
+        os.fsync(f.fileno())
+        buffer[:] = b''
+
+
+def _close(f, buffer):
+    _flush(f, buffer)
+    f.close()
+
+
+def _apply(distor, kind, r):
+    if kind == ADDED:
+        compact = bool(r._unpack(_FLAG)[0])
+        name = r.string()
+        resources = r.quantities()
+        loads = [r.workload(compact) for i in range(r.count())]
+        make = CompactNode if compact else Node
+        distor.add_node(make(name, resources,
+                             dict((l.name, l) for l in loads)))
+        return
+    node = distor.get_node(r.string())
+    if node is None:
+        raise LighthouseException("Journal names an unknown node")
+    if kind == ATTACH:
+        load = r.workload(isinstance(node, CompactNode))
+        used = dict((k, node.resources[k] - v)
+                    for k, v in load.requirements.items())
+        node._commit(load, used, restored=True)
+    elif kind == DETACH:
+        # Loads detached together are detached together again, so that
+        # the quantities and scores come out the same
+        names = r.names()
+        if len(names) > 1 and \
+                set(names) == set(node.assigned_workloads.keys()):
+            node.detach_all()
+        else:
+            for name in names:
+                node.detach(name)
+    elif kind == RESOURCES:
+        resources = r.quantities()
+        gone = [k for k in node.resources.keys() if k not in resources]
+        for k in gone:
+            del node.resources[k]
+        node._reward(gone)
+        node.update_resources(resources)
+    elif kind == PLACED:
+        distor._placed(node, node.assigned_workloads.get(r.string()))
+    elif kind == REMOVED:
+        distor.remove_node(node.name, drain=True)
+    elif kind == RECALLED:
+        distor._recall(node, r.memo())
+
+
+def replay(distor, path):
+    '''
+    Apply the changes recorded in the journal at ``path`` to ``distor``,
+    which should have been restored from the snapshot the journal follows.
+    A journal following some other snapshot is ignored. Returns the number
+    of records applied.
+    '''
+    if distor.journal is not None:
+        raise LighthouseException(
+            "Cannot replay into a distributor which is journaling")
+    applied = 0
+    with open(path, 'rb') as f:
+        if _read_header(f) != distor._snapshot_token:
+            return 0
+        for kind, payload in _records(f):
+            _apply(distor, kind, _Reader(payload))
+            applied += 1
+    return applied
+
+
+def recover(snapshot_path, journal_path):
+    '''
+    Restore a distributor from its last snapshot and the journal since.
+    '''
+    distor = Distributor.restore(snapshot_path)
+    if os.path.exists(journal_path):
+        replay(distor, journal_path)
+    return distor
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""Streaming bulk loaders of compact nodes and workloads."""
+
+import json
+
+from pylighthouse.compact import CompactNode, CompactWorkload, ResourceVector
+from pylighthouse.pylighthouse import DEFAULT_SCHEMA
+
+
+class _Opened(object):
+    '''
+    Opens a path, or passes an already open file through untouched.
+    '''
+
+    def __init__(self, source, mode):
+        self.source = source
+        self.mode = mode
+        self.file = None
+
+    def __enter__(self):
+        if hasattr(self.source, 'read'):
+            return self.source
+        self.file = open(self.source, self.mode)
+        return self.file
+
+    def __exit__(self, *exc):
+        if self.file is not None:
+            self.file.close()
+        return False
+
+
+def _workload(record, schema):
+    return CompactWorkload._assemble(
+        record['name'], ResourceVector(record['requirements'], schema),
+        record.get('immunities') or (), record.get('aversion_groups') or ())
+
+
+def _node(record, schema):
+    assigned = record.get('assigned_workloads')
+    workloads = None
+    if assigned:
+        if hasattr(assigned, 'values'):
+            assigned = assigned.values()
+        workloads = dict((w.name, w) for w in
+                         (_workload(r, schema) for r in assigned))
+    return CompactNode(record['name'],
+                       ResourceVector(record['resources'], schema),
+                       workloads, schema)
+
+
+def _json_lines(source):
+    with _Opened(source, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _msgpack(source):
+    import msgpack
+    with _Opened(source, 'rb') as f:
+        for record in msgpack.Unpacker(f, raw=False):
+            yield record
+
+
+# JSON Lines holds one record per line, in the form taken by
+# Node.from_dict or Workload.from_dict
+def nodes_from_jsonl(source, schema=DEFAULT_SCHEMA):
+    for record in _json_lines(source):
+        yield _node(record, schema)
+
+
+def workloads_from_jsonl(source, schema=DEFAULT_SCHEMA):
+    for record in _json_lines(source):
+        yield _workload(record, schema)
+
+
+# Msgpack holds a stream of maps, in the same form. Requires msgpack.
+def nodes_from_msgpack(source, schema=DEFAULT_SCHEMA):
+    for record in _msgpack(source):
+        yield _node(record, schema)
+
+
+def workloads_from_msgpack(source, schema=DEFAULT_SCHEMA):
+    for record in _msgpack(source):
+        yield _workload(record, schema)
+
+
+def _batches(data):
+    if hasattr(data, 'to_batches'):
+        return data.to_batches()
+    if hasattr(data, 'num_rows') and hasattr(data, 'column'):
+        return [data]
+    return data
+
+
+def _column(batch, name):
+    index = batch.schema.get_field_index(name)
+    if index < 0:
+        return None
+    return batch.column(index)
+
+
+# Per row lists of (resource, quantity) from a struct column, one field per
+# resource with nulls where absent, or from a map column
+def _quantities(batch, name):
+    import pyarrow
+    column = _column(batch, name)
+    if not pyarrow.types.is_struct(column.type):
+        return [row or () for row in column.to_pylist()]
+    rows = [[] for i in range(batch.num_rows)]
+    for f in range(column.type.num_fields):
+        key = column.type.field(f).name
+        for row, v in zip(rows, column.field(f).to_pylist()):
+            if v is not None:
+                row.append((key, v))
+    return rows
+
+
+def _names(batch, name):
+    column = _column(batch, name)
+    if column is None:
+        return [()] * batch.num_rows
+    return [row or () for row in column.to_pylist()]
+
+
+# Arrow data is a Table, a RecordBatch, or an iterable of them, with a
+# string ``name`` column and a ``resources`` or ``requirements`` column of
+# struct or map type. Workloads may also have list of string
+# ``immunities`` and ``aversion_groups`` columns. Columns are converted
+# a batch at a time, rather than row by row. Requires pyarrow.
+def nodes_from_arrow(data, schema=DEFAULT_SCHEMA):
+    for batch in _batches(data):
+        names = _column(batch, 'name').to_pylist()
+        resources = _quantities(batch, 'resources')
+        for name, quantities in zip(names, resources):
+            yield CompactNode(name, ResourceVector(quantities, schema),
+                              None, schema)
+
+
+def workloads_from_arrow(data, schema=DEFAULT_SCHEMA):
+    for batch in _batches(data):
+        names = _column(batch, 'name').to_pylist()
+        requirements = _quantities(batch, 'requirements')
+        immunities = _names(batch, 'immunities')
+        groups = _names(batch, 'aversion_groups')
+        for row in zip(names, requirements, immunities, groups):
+            yield CompactWorkload._assemble(
+                row[0], ResourceVector(row[1], schema), row[2], row[3])
+
+
+def _parquet(path, batch_size):
+    import pyarrow.parquet
+    return pyarrow.parquet.ParquetFile(path).iter_batches(batch_size)
+
+
+# Parquet files are read a batch of rows at a time, laid out as for Arrow
+def nodes_from_parquet(path, schema=DEFAULT_SCHEMA, batch_size=65536):
+    return nodes_from_arrow(_parquet(path, batch_size), schema)
+
+
+def workloads_from_parquet(path, schema=DEFAULT_SCHEMA, batch_size=65536):
+    return workloads_from_arrow(_parquet(path, batch_size), schema)
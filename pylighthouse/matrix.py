@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""Columnar, NumPy-backed view of node resources."""
+
+import weakref
+
+import numpy
+
+
+# Mask of the rows of a table which can accept a compiled requirement
+def _kernel(values, present, cols, guarded, need, warded):
+    mask = numpy.ones(values.shape[0], dtype=bool)
+    if cols:
+        mask &= present[:, cols].all(axis=1)
+    if guarded:
+        mask &= ~((values[:, guarded] - need) < 0).any(axis=1)
+    if warded:
+        mask &= ~(values[:, warded] < 0).any(axis=1)
+    return mask
+
+
+class ResourceMatrix(object):
+    '''
+    Dense table of node resources, one row per node and one column per
+    resource name. Missing resources are stored as zero and flagged in the
+    ``present`` table, so tags and wards keep their meaning.
+
+    The matrix is a screen, not the source of truth: the nodes' own
+    ``resources`` dictionaries are. Call ``update`` whenever a node's
+    resources change so that its row follows.
+    '''
+
+    def __init__(self, nodes):
+        nodes = list(nodes)
+        self.batch = None
+        self.columns = {}
+        self.names = []
+        for n in nodes:
+            for k in n.resources:
+                self._intern(k)
+        # node name -> row, and row -> node name
+        self.rows = {}
+        self.order = []
+        # Tables may have spare rows beyond the first size ones
+        self.size = len(nodes)
+        self.values = self._allocate((len(nodes), len(self.names)), float)
+        self.present = self._allocate((len(nodes), len(self.names)), bool)
+        self.negative = numpy.zeros(len(self.names), dtype=int)
+        for i, n in enumerate(nodes):
+            self.rows[n.name] = i
+            self.order.append(n.name)
+            self._fill(i, n.resources)
+
+    def _intern(self, key):
+        if key not in self.columns:
+            self.columns[key] = len(self.names)
+            self.names.append(key)
+        return self.columns[key]
+
+    # Returns a zeroed table
+    def _allocate(self, shape, dtype):
+        return numpy.zeros(shape, dtype=dtype)
+
+    def _reshape(self, rows, cols):
+        used, old_cols = self.size, self.values.shape[1]
+        values = self._allocate((rows, cols), float)
+        values[:used, :old_cols] = self.values[:used]
+        present = self._allocate((rows, cols), bool)
+        present[:used, :old_cols] = self.present[:used]
+        self.values = values
+        self.present = present
+
+    def _widen(self):
+        extra = len(self.names) - self.values.shape[1]
+        if extra > 0:
+            self._reshape(self.values.shape[0], len(self.names))
+            self.negative = numpy.concatenate(
+                (self.negative, numpy.zeros(extra, dtype=int)))
+
+    def _fill(self, row, resources):
+        self.negative -= self.values[row] < 0
+        self.values[row] = 0
+        self.present[row] = False
+        for k, v in resources.items():
+            c = self.columns[k]
+            self.values[row, c] = v
+            self.present[row, c] = True
+        self.negative += self.values[row] < 0
+
+    def update(self, node):
+        for k in node.resources:
+            self._intern(k)
+        self._widen()
+        row = self.rows[node.name]
+        self._fill(row, node.resources)
+        if self.batch is not None:
+            self.batch.refresh(row)
+
+    def add(self, node):
+        for k in node.resources:
+            self._intern(k)
+        self._widen()
+        if self.size == self.values.shape[0]:
+            self._reshape(max(1, 2 * self.size), self.values.shape[1])
+        row = self.size
+        self.size += 1
+        self.rows[node.name] = row
+        self.order.append(node.name)
+        self._fill(row, node.resources)
+        self.batch = None
+
+    # The last row moves into the removed node's place
+    def remove(self, node):
+        row = self.rows.pop(node.name)
+        last = self.size - 1
+        self.negative -= self.values[row] < 0
+        moved = self.order.pop()
+        if row != last:
+            self.values[row] = self.values[last]
+            self.present[row] = self.present[last]
+            self.rows[moved] = row
+            self.order[row] = moved
+        self.values[last] = 0
+        self.present[last] = False
+        self.size = last
+        self.batch = None
+
+    def _compile(self, load):
+        keys = list(load.requirements.keys())
+        for k in keys:
+            if k not in self.columns:
+                return None
+        cols = [self.columns[k] for k in keys]
+        guarded = [i for i, k in enumerate(keys)
+                   if k not in load.immunities]
+        need = numpy.array([load.requirements[keys[i]] for i in guarded],
+                           dtype=float)
+        return (cols, [cols[i] for i in guarded], need,
+                frozenset(load.immunities))
+
+    # Columns holding a negative value somewhere which the requirement
+    # neither uses nor is immune to
+    def _warded(self, req):
+        cols, guarded, need, immunities = req
+        used = set(cols)
+        return [c for c in numpy.flatnonzero(self.negative)
+                if c not in used and self.names[c] not in immunities]
+
+    def _evaluate(self, req, rows=slice(None)):
+        values = self.values[:self.size][rows]
+        if req is None:
+            return numpy.zeros(values.shape[0], dtype=bool)
+        cols, guarded, need, immunities = req
+        return _kernel(values, self.present[:self.size][rows], cols,
+                       guarded, need, self._warded(req))
+
+    def feasible(self, load):
+        '''
+        Return a boolean array, indexed by row, telling which nodes have
+        the capacity, tags and ward immunities to accept ``load``.
+        '''
+        return self._evaluate(self._compile(load))
+
+    def _predicate(self, mask):
+        rows = self.rows
+        return lambda node: mask[rows[node.name]]
+
+    def screen(self, load):
+        '''
+        Return a predicate over nodes which is False for every node that
+        cannot possibly accept ``load``.
+        '''
+        if self.batch is not None:
+            mask = self.batch.mask(load)
+            if mask is not None:
+                return self._predicate(mask)
+        return self._predicate(self.feasible(load))
+
+    def begin(self, loads):
+        '''
+        Precompile the requirements of a batch of loads. Until ``end`` is
+        called, feasibility masks for the batch are kept up to date
+        incrementally as rows change instead of being recomputed.
+        '''
+        self.batch = Batch(self, loads)
+
+    def end(self):
+        self.batch = None
+
+
+class Batch(object):
+    '''
+    Feasibility masks for a batch of loads, shared between loads with the
+    same requirements and immunities. A mask is computed the first time one
+    of its loads is screened, refreshed one row at a time as nodes change,
+    and dropped once its last load has been screened.
+    '''
+
+    def __init__(self, matrix, loads):
+        self.matrix = matrix
+        self.requirements = []
+        self.pending = []
+        self.masks = {}
+        self.shapes = {}
+        signatures = {}
+        for l in loads:
+            sig = (frozenset(l.requirements.items()),
+                   frozenset(l.immunities))
+            if sig not in signatures:
+                signatures[sig] = len(self.requirements)
+                self.requirements.append(matrix._compile(l))
+                self.pending.append(0)
+            shape = signatures[sig]
+            self.pending[shape] += 1
+            self.shapes[id(l)] = shape
+
+    def mask(self, load):
+        shape = self.shapes.pop(id(load), None)
+        if shape is None:
+            return None
+        mask = self.masks.get(shape)
+        if mask is None:
+            mask = self.matrix._evaluate(self.requirements[shape])
+            self.masks[shape] = mask
+        self.pending[shape] -= 1
+        if self.pending[shape] == 0:
+            del self.masks[shape]
+        return mask
+
+    def refresh(self, row):
+        for shape, mask in self.masks.items():
+            mask[row] = self.matrix._evaluate(self.requirements[shape],
+                                              [row])[0]
+
+
+# Shared memory blocks a worker process has attached to, by name
+_attached = {}
+
+
+def _attach(spec, keep):
+    name, shape, dtype = spec
+    for stale in [n for n in _attached if n not in keep]:
+        _attached.pop(stale)[0].close()
+    found = _attached.get(name)
+    if found is None:
+        from multiprocessing import resource_tracker, shared_memory
+        block = shared_memory.SharedMemory(name=name)
+        # The parent owns the block and unlinks it; do not let this
+        # process's tracker do so as well.
+        resource_tracker.unregister(block._name, 'shared_memory')
+        found = (block, numpy.ndarray(shape, dtype=dtype, buffer=block.buf))
+        _attached[name] = found
+    return found[1]
+
+
+def _scan(values, present, start, stop, cols, guarded, need, warded):
+    if not isinstance(values, numpy.ndarray):
+        keep = (values[0], present[0])
+        values = _attach(values, keep)
+        present = _attach(present, keep)
+    return _kernel(values[start:stop], present[start:stop],
+                   cols, guarded, need, warded)
+
+
+def _release(blocks, executor):
+    executor.shutdown(wait=True)
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+class ParallelResourceMatrix(ResourceMatrix):
+    '''
+    ResourceMatrix which splits full-table scans into contiguous shards of
+    rows evaluated on a pool of workers. With processes, the table lives in
+    shared memory which the workers map once, so only the compiled
+    requirement is sent with each scan. Masks are joined in row order, so
+    results are identical to a sequential scan.
+    '''
+
+    def __init__(self, nodes, workers, processes=True, shard_rows=4096):
+        import concurrent.futures
+        self.processes = processes
+        self.shard_rows = shard_rows
+        self.workers = workers
+        self.blocks = []
+        # id of each shared table -> (block name, shape, dtype)
+        self.specs = {}
+        if processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._finalizer = weakref.finalize(self, _release, self.blocks,
+                                           self.executor)
+        super(ParallelResourceMatrix, self).__init__(nodes)
+
+    def _allocate(self, shape, dtype):
+        if not self.processes:
+            return numpy.zeros(shape, dtype=dtype)
+        from multiprocessing import shared_memory
+        dtype = numpy.dtype(dtype)
+        size = max(1, int(numpy.prod(shape)) * dtype.itemsize)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        table = numpy.ndarray(shape, dtype=dtype, buffer=block.buf)
+        table[...] = 0
+        self.blocks.append(block)
+        self.specs[id(table)] = (block.name, shape, dtype)
+        return table
+
+    def _reshape(self, rows, cols):
+        stale = (id(self.values), id(self.present))
+        super(ParallelResourceMatrix, self)._reshape(rows, cols)
+        if not self.processes:
+            return
+        for table in stale:
+            if table in (id(self.values), id(self.present)):
+                continue
+            name = self.specs.pop(table)[0]
+            for block in [b for b in self.blocks if b.name == name]:
+                self.blocks.remove(block)
+                block.close()
+                block.unlink()
+
+    def _table(self, table):
+        if self.processes:
+            return self.specs[id(table)]
+        return table
+
+    def _evaluate(self, req, rows=slice(None)):
+        total = self.size
+        if req is None or rows != slice(None) or total <= self.shard_rows:
+            return super(ParallelResourceMatrix, self)._evaluate(req, rows)
+        cols, guarded, need, immunities = req
+        warded = self._warded(req)
+        shards = min(self.workers, -(-total // self.shard_rows))
+        step = -(-total // shards)
+        values = self._table(self.values)
+        present = self._table(self.present)
+        futures = [self.executor.submit(_scan, values, present, start,
+                                        min(total, start + step), cols,
+                                        guarded, need, warded)
+                   for start in range(0, total, step)]
+        return numpy.concatenate([f.result() for f in futures])
+
+    def close(self):
+        self._finalizer()
@@ -15,29 +15,198 @@
 
 """Main module."""
 
-from sortedcontainers import SortedDict
+import bisect
+import heapq
+import math
+import threading
+import weakref
+
+from sortedcontainers import SortedDict, SortedList
 
 class LighthouseException(Exception):
     pass
 
 
-class Workload(object):
-    def __init__(self, name, requirements, immunities=set(),
-                 aversion_groups=set()):
+class _Unlocked(object):
+    '''
+    Stand-in for a lock, used by nodes and distributors until locking is
+    turned on with ``Distributor.use_locking``.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    # Copies and pickles stay the one stand-in, so that it is still
+    # recognised by identity
+    def __reduce__(self):
+        return '_UNLOCKED'
+
+
+_UNLOCKED = _Unlocked()
+
+
+class ResourceSchema(object):
+    '''
+    Registry mapping resource names to small, stable integer indices, shared
+    by every object interned against it.
+    '''
+
+    def __init__(self):
+        self.indices = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        index = self.indices.get(name)
+        if index is None:
+            index = len(self.names)
+            self.indices[name] = index
+            self.names.append(name)
+        return index
+
+    # The default schema is shared by copies and pickles of the objects
+    # interned against it, rather than copied with them
+    def __reduce__(self):
+        if self is DEFAULT_SCHEMA:
+            return 'DEFAULT_SCHEMA'
+        return (ResourceSchema, (), self.__dict__)
+
+
+DEFAULT_SCHEMA = ResourceSchema()
+
+
+class _Plan(object):
+    '''
+    What a workload asks of a node, compiled once and reused by every
+    attempt to place the workload for as long as it asks the same.
+    '''
+
+    __slots__ = ('needs', 'signed', 'required', 'exempt', 'groups',
+                 'requirements', 'immunities', 'aversions')
+
+    def __init__(self, load):
+        immunities = frozenset(load.immunities)
+        # (resource, quantity, immune) for each requirement
+        self.needs = tuple((k, v, k in immunities)
+                           for k, v in load.requirements.items())
+        # Whether placing or removing the load may take a resource across
+        # zero: it is immune to running short, or overcomes a shortcoming
+        self.signed = any(i or v < 0 for k, v, i in self.needs)
+        self.required = _mask(load.requirements.keys())
+        # Resources whose negative quantities are not wards to the load
+        self.exempt = self.required | _mask(immunities)
+        self.groups = tuple(load.aversion_groups)
+        # What the plan was compiled from
+        self.requirements = _fingerprint(load.requirements, True)
+        self.immunities = immunities
+        self.aversions = frozenset(self.groups)
+
+    # Whether the load still asks what it did when the plan was compiled.
+    # Comparing is much cheaper than compiling again, and catches changes
+    # made in place to the load's containers as well as replaced ones.
+    def current(self, load):
+        requirements = load.requirements
+        if type(requirements) is not dict:
+            requirements = _fingerprint(requirements)
+        if self.requirements != requirements:
+            return False
+        immunities = load.immunities
+        if type(immunities) not in _SETS:
+            immunities = frozenset(immunities)
+        groups = load.aversion_groups
+        if type(groups) not in _SETS:
+            groups = frozenset(groups)
+        return self.immunities == immunities and self.aversions == groups
+
+
+_SETS = (set, frozenset)
+
+
+# Something cheaply compared which changes whenever the quantities do:
+# what the container offers, if anything, or else the quantities
+# themselves, copied when they are to be kept
+def _fingerprint(quantities, keep=False):
+    fingerprint = getattr(quantities, '_fingerprint', None)
+    if fingerprint is not None:
+        return fingerprint()
+    if keep:
+        return dict(quantities)
+    return quantities
+
+
+# Bitmask of the given resource names' indices in the default schema
+def _mask(names):
+    mask = 0
+    for k in names:
+        mask |= 1 << DEFAULT_SCHEMA.intern(k)
+    return mask
+
+
+class _BaseWorkload(object):
+    '''
+    Behaviour shared by Workload and CompactWorkload. It declares no
+    instance attributes, so that CompactWorkload, which lists its own in
+    ``__slots__``, has no instance dictionary.
+    '''
+
+    __slots__ = ()
+    _plan = None
+
+    def __init__(self, name, requirements, immunities=None,
+                 aversion_groups=None):
         self.name = name
         self.requirements = requirements
+        if immunities is None:
+            immunities = set()
         self.immunities = immunities
+        if aversion_groups is None:
+            aversion_groups = set()
         self.aversion_groups = aversion_groups
+        self._plan = None
+
+    # Builds a workload without going through __init__, for bulk loading
+    @classmethod
+    def _assemble(cls, name, requirements, immunities, aversion_groups):
+        w = object.__new__(cls)
+        w.name = name
+        w.requirements = requirements
+        w.immunities = set(immunities)
+        w.aversion_groups = set(aversion_groups)
+        w._plan = None
+        return w
+
+    # The compiled plan, compiled again whenever the workload's
+    # requirements, immunities or aversion groups have changed. Checking
+    # costs about as much as a fit, so distributors check once per load
+    # and hand the plan to every node they try.
+    def _compiled(self):
+        plan = self._plan
+        if plan is None or not plan.current(self):
+            plan = _Plan(self)
+            self._plan = plan
+        return plan
 
     def __eq__(self, other):
         return type(self) == type(other) and \
-                self.__dict__ == other.__dict__
+                self._state() == other._state()
 
     def __str__(self):
-        return str(self.__dict__)
+        return str(self._state())
 
     def __repr__(self):
-        return str(self.__dict__)
+        return str(self._state())
+
+
+class Workload(_BaseWorkload):
+    # Public attributes only; underscored ones are derived caches
+    def _state(self):
+        return dict((k, v) for k, v in self.__dict__.items()
+                    if not k.startswith('_'))
 
     @staticmethod
     def from_list(ds):
@@ -64,7 +233,14 @@ class Workload(object):
                         aversion_groups)
 
 
-class Node(object):
+class _BaseNode(object):
+    '''
+    Behaviour shared by Node and CompactNode, declaring no instance
+    attributes so that CompactNode has no instance dictionary.
+    '''
+
+    __slots__ = ()
+
     def __init__(self, name, resources, assigned_workloads=None):
         self.name = name
         self.resources = resources
@@ -72,70 +248,134 @@ class Node(object):
             self.assigned_workloads = assigned_workloads
         else:
             self.assigned_workloads = dict()
+        # aversion group -> number of assigned workloads in it
+        self._aversions = dict()
+        for w in self.assigned_workloads.values():
+            self._avert(w, 1)
+        self._watchers = []
+        self._mutex = _UNLOCKED
+        # Bitmask of the resources the node holds negative quantities of
+        self._wards = 0
+        self._reward(self.resources.keys())
 
     def __eq__(self, other):
         return type(self) == type(other) and \
-                self.__dict__ == other.__dict__
+                self._state() == other._state()
 
     def __str__(self):
-        return str(self.__dict__)
+        return str(self._state())
 
     def __repr__(self):
-        return str(self.__dict__)
+        return str(self._state())
 
-    @staticmethod
-    def from_list(ns):
-        return [Node.from_dict(n) for n in ns]
+    # Copies and pickles of a node are not watched by the distributors of
+    # the original, nor locked; a distributor copied along with its nodes
+    # watches, and locks, the copies itself
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', ()))
+        for k in type(self).__slots__:
+            state[k] = getattr(self, k)
+        del state['_watchers']
+        del state['_mutex']
+        return state
 
-    @staticmethod
-    def from_dict(d):
-        if 'assigned_workloads' in d:
-            return Node(d['name'], d['resources'], d['assigned_workloads'])
-        else:
-            return Node(d['name'], d['resources'])
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+        self._watchers = []
+        self._mutex = _UNLOCKED
+
+    # Distributors watch the nodes they hold so that their indexes follow
+    # changes to the node, whichever way those changes are made.
+    def _watch(self, watcher):
+        self._watchers = [r for r in self._watchers if r() is not None]
+        self._watchers.append(weakref.ref(watcher))
+
+    def _unwatch(self, watcher):
+        self._watchers = [r for r in self._watchers
+                          if r() is not None and r() is not watcher]
+
+    def _notify(self, event, *args):
+        for r in self._watchers:
+            w = r()
+            if w is not None:
+                with w._mutex:
+                    getattr(w, event)(self, *args)
+
+    def _avert(self, load, delta):
+        for g in load.aversion_groups:
+            count = self._aversions.get(g, 0) + delta
+            if count > 0:
+                self._aversions[g] = count
+            else:
+                self._aversions.pop(g, None)
+
+    # Brings the node's ward bits for the given resources up to date
+    def _reward(self, keys):
+        for k in keys:
+            bit = 1 << DEFAULT_SCHEMA.intern(k)
+            if k in self.resources and self.resources[k] < 0:
+                self._wards |= bit
+            else:
+                self._wards &= ~bit
 
     def has_averse_loads(self, load):
-        groups = load.aversion_groups
-        for nw, w in self.assigned_workloads.items():
-            if len(groups.intersection(w.aversion_groups)) > 0:
+        return self._averse(load._compiled())
+
+    def _averse(self, plan):
+        for g in plan.groups:
+            if g in self._aversions:
                 return True
         return False
 
-    # Returns True if it worked, False otherwise
-    def attempt_attach(self, load):
-        have_keys = set(self.resources.keys())
-        need_keys = set(load.requirements.keys())
-        present_keys = have_keys.union(need_keys)
-        
-        # Check that requirements are a subset of resources
-        if len(present_keys) > len(have_keys):
-            return False
+    # Returns the resource values the node would be left with
+    # if the load were attached, or None if it cannot be. The load's
+    # plan may be passed in when it is known to be current.
+    def _fit(self, load, plan=None):
+        if plan is None:
+            plan = load._compiled()
 
-        used_keys = have_keys.intersection(need_keys)
+        # Check that no resource the load doesn't use is negative,
+        # unless the load is immune to it
+        if self._wards & ~plan.exempt:
+            return None
+
+        resources = self.resources
         used = dict()
 
-        # Check to make sure all un-tolerated
-        # values are zero or above,
-        # first in the keys of resources that will be used
-        for k in used_keys:
-            v = self.resources[k] - load.requirements[k]
-            if k not in load.immunities and \
-                    v < 0:
-                return False
+        # and that requirements are a subset of resources, and that
+        # all un-tolerated values would stay zero or above
+        for k, need, immune in plan.needs:
+            if k not in resources:
+                return None
+            v = resources[k] - need
+            if v < 0 and not immune:
+                return None
             used[k] = v
 
-        # and then check keys of resources that aren't being used
-        check_keys = have_keys.difference(used_keys)
-        for k in check_keys:
-            if k not in load.immunities and \
-                    self.resources[k] < 0:
-                return False
+        return used
 
-        # Everything looks good, commit the resource
-        # allocation and return True
+    # Quantities not worked out by _fit, such as those a rollback or a
+    # journal restores, may cross zero whatever the load, so their ward
+    # bits are always brought up to date when `restored`
+    def _commit(self, load, used, restored=False, plan=None):
         self.resources.update(used)
+        if plan is None:
+            plan = load._compiled()
+        if restored or plan.signed or self._wards & plan.required:
+            self._reward(used)
         self.assigned_workloads[load.name] = load
-        return True
+        self._avert(load, 1)
+        self._notify('_node_attached', load)
+
+    # Returns True if it worked, False otherwise
+    def attempt_attach(self, load):
+        with self._mutex:
+            used = self._fit(load)
+            if used is None:
+                return False
+            self._commit(load, used)
+            return True
 
     def attempt_attach_amicable(self, load):
         if self.has_averse_loads(load):
@@ -143,74 +383,921 @@ class Node(object):
         else:
             return self.attempt_attach(load)
 
-    def detach_all(self):
-        for wname, w in self.assigned_workloads.items():
-            for k, v in w.requirements.items():
+    # Returns the detached workload, or None if it was not attached
+    def detach(self, name):
+        with self._mutex:
+            load = self.assigned_workloads.pop(name, None)
+            if load is None:
+                return None
+            for k, v in load.requirements.items():
                 self.resources[k] = self.resources[k] + v
-        self.assigned_workloads = dict()
+            plan = load._compiled()
+            if plan.signed or self._wards & plan.required:
+                self._reward(load.requirements.keys())
+            self._avert(load, -1)
+            self._notify('_node_detached', [load])
+            return load
+
+    def detach_all(self):
+        with self._mutex:
+            for wname, w in self.assigned_workloads.items():
+                for k, v in w.requirements.items():
+                    self.resources[k] = self.resources[k] + v
+            detached = list(self.assigned_workloads.values())
+            if self._wards:
+                self._reward(self.resources.keys())
+            self.assigned_workloads = dict()
+            self._aversions = dict()
+            self._notify('_node_detached', detached)
 
     def add_ward(self, ward):
-        self.resources[ward] = -float("inf")
+        with self._mutex:
+            self.resources[ward] = -float("inf")
+            self._wards |= _mask([ward])
+            self._notify('_node_changed')
+
+    def update_resources(self, resources):
+        with self._mutex:
+            self.resources.update(resources)
+            self._reward(resources.keys())
+            self._notify('_node_changed')
+
+
+class Node(_BaseNode):
+    def _state(self):
+        return dict((k, v) for k, v in self.__dict__.items()
+                    if not k.startswith('_'))
+
+    @staticmethod
+    def from_list(ns):
+        return [Node.from_dict(n) for n in ns]
+
+    @staticmethod
+    def from_dict(d):
+        if 'assigned_workloads' in d:
+            return Node(d['name'], d['resources'], d['assigned_workloads'])
+        else:
+            return Node(d['name'], d['resources'])
+
+
+class _Overlay(object):
+    '''
+    A node's resources with some quantities replaced, leaving the node's
+    own mapping untouched.
+    '''
+
+    def __init__(self, resources):
+        self.resources = resources
+        self.changes = {}
+
+    def keys(self):
+        return self.resources.keys()
+
+    def items(self):
+        return ((k, self[k]) for k in self.resources.keys())
+
+    def __len__(self):
+        return len(self.resources)
+
+    def __contains__(self, key):
+        return key in self.resources
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            return self.changes[key]
+        return self.resources[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
+class _ScratchNode(Node):
+    '''
+    View of a node with workloads notionally attached to it, used to plan
+    a gang's placement without changing the node itself.
+    '''
+
+    def __init__(self, node):
+        self.node = node
+        self.name = node.name
+        self.resources = _Overlay(node.resources)
+        self.groups = set()
+        self._wards = node._wards
+
+    def _averse(self, plan):
+        for g in plan.groups:
+            if g in self.groups:
+                return True
+        return self.node._averse(plan)
+
+    def _commit(self, load, used):
+        self.resources.changes.update(used)
+        self.groups.update(load.aversion_groups)
+        for k, v in used.items():
+            bit = 1 << DEFAULT_SCHEMA.intern(k)
+            if v < 0:
+                self._wards |= bit
+            else:
+                self._wards &= ~bit
+
+
+class AversionIndex(object):
+    '''
+    Cluster-wide reverse index from aversion group to the names of the nodes
+    hosting at least one workload in that group.
+    '''
+
+    def __init__(self, nodes=()):
+        self.groups = {}
+        for n in nodes:
+            for w in n.assigned_workloads.values():
+                self.add(n, w)
+
+    def add(self, node, load):
+        for g in load.aversion_groups:
+            self.groups.setdefault(g, set()).add(node.name)
+
+    # Call after the load has left the node
+    def remove(self, node, load):
+        for g in load.aversion_groups:
+            if g not in node._aversions:
+                names = self.groups.get(g)
+                if names is not None:
+                    names.discard(node.name)
+                    if not names:
+                        del self.groups[g]
+
+    def averse_nodes(self, load):
+        found = set()
+        for g in load.aversion_groups:
+            found.update(self.groups.get(g, ()))
+        return found
+
+
+class CapacityIndex(object):
+    '''
+    Per-resource sorted index of node quantities, answering "which nodes
+    have at least this much of that resource?" by bisection.
+    '''
+
+    def __init__(self, nodes=()):
+        # resource name -> SortedList of (quantity, node name)
+        self.trees = {}
+        # node name -> {resource name: quantity as indexed}
+        self.indexed = {}
+        for n in nodes:
+            self.update(n)
+
+    # Re-index the given resources of the node, or all of them
+    def update(self, node, keys=None):
+        indexed = self.indexed.setdefault(node.name, {})
+        if keys is None:
+            keys = set(indexed.keys()).union(node.resources.keys())
+        for k in keys:
+            if k in indexed:
+                self.trees[k].remove((indexed.pop(k), node.name))
+            if k in node.resources:
+                v = node.resources[k]
+                self.trees.setdefault(k, SortedList()).add((v, node.name))
+                indexed[k] = v
+
+    def remove(self, node):
+        for k, v in self.indexed.pop(node.name, {}).items():
+            self.trees[k].remove((v, node.name))
+
+    def count(self, key, amount):
+        tree = self.trees.get(key)
+        if tree is None:
+            return 0
+        return len(tree) - tree.bisect_left((amount,))
+
+    def fitting(self, key, amount):
+        tree = self.trees.get(key)
+        if tree is None:
+            return
+        for v, name in tree.irange(minimum=(amount,)):
+            yield name
+
+    # The non-immune requirement of the load which the fewest nodes have
+    # room for, as (key, amount, count), or None if the load guards nothing
+    def scarcest(self, load):
+        found = None
+        for k, v in load.requirements.items():
+            if k in load.immunities:
+                continue
+            c = self.count(k, v)
+            if found is None or c < found[2]:
+                found = (k, v, c)
+        return found
+
+
+class HeadroomIndex(object):
+    '''
+    Per-resource sorted sets of the nodes with more than none of that
+    resource left, keyed by the order in which the nodes were added. That
+    is the order of a distributor's list of nodes, and a key does not
+    change as other nodes are removed. The next such node at or after any
+    node is found by bisection.
+    '''
+
+    def __init__(self, nodes=()):
+        self.rebuild(nodes)
+
+    def rebuild(self, nodes):
+        # resource name -> SortedList of keys
+        self.positions = {}
+        # node name -> key
+        self.at = {}
+        # key -> node
+        self.nodes = {}
+        # node name -> resource names indexed for it
+        self.held = {}
+        self.added = 0
+        for n in nodes:
+            self.add(n)
+
+    def add(self, node):
+        self.at[node.name] = self.added
+        self.nodes[self.added] = node
+        self.added += 1
+        self.held[node.name] = set()
+        self.update(node)
+
+    def remove(self, node):
+        i = self.at.pop(node.name)
+        del self.nodes[i]
+        for k in self.held.pop(node.name):
+            self.positions[k].remove(i)
+
+    # Re-index the given resources of the node, or all of them
+    def update(self, node, keys=None):
+        i = self.at[node.name]
+        held = self.held[node.name]
+        if keys is None:
+            keys = held.union(node.resources.keys())
+        for k in keys:
+            has = k in node.resources and node.resources[k] > 0
+            if has and k not in held:
+                held.add(k)
+                self.positions.setdefault(k, SortedList()).add(i)
+            elif not has and k in held:
+                held.discard(k)
+                self.positions[k].remove(i)
+
+    # Keys of the nodes with headroom in whichever resource the load needs
+    # some of, and is not immune to running short of, that the fewest
+    # nodes have; None if the load guards no such resource. No other node
+    # can take the load.
+    def scarcest(self, load):
+        found = None
+        for k, need, immune in load._compiled().needs:
+            if immune or not need > 0:
+                continue
+            positions = self.positions.get(k, ())
+            if found is None or len(positions) < len(found):
+                found = positions
+        return found
+
+    # The nodes at the keys in a wrap around from start
+    def following(self, positions, start):
+        if not positions:
+            return
+        for i in positions.irange(minimum=start):
+            yield self.nodes[i]
+        for i in positions.irange(maximum=start, inclusive=(True, False)):
+            yield self.nodes[i]
+
+
+# Marks a resource a node did not have before a change
+_ABSENT = object()
+
+
+class Transaction(object):
+    '''
+    Undo log of the placements, releases and resource updates made through
+    a distributor while the transaction is open. Rolling back undoes them
+    in reverse order, restoring the exact quantities, indexes and
+    round-robin position from before, in time proportional to the number
+    of changes. Transactions may be nested; rolling one back undoes only
+    what was done since it began.
+
+    Used as a context manager, a transaction commits when the block exits
+    normally and rolls back when it raises.
+    '''
+
+    def __init__(self, distributor):
+        self.distributor = distributor
+        self.outermost = distributor._undo is None
+        if self.outermost:
+            distributor._undo = []
+        self.start = len(distributor._undo)
+        self.open = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.open:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        return False
+
+    def _close(self):
+        if not self.open:
+            raise LighthouseException("Transaction is already closed")
+        self.open = False
+        if self.outermost:
+            self.distributor._undo = None
+
+    # Keeps the changes; within an outer transaction they can still be
+    # rolled back with it
+    def commit(self):
+        self._close()
+
+    def rollback(self):
+        if not self.open:
+            raise LighthouseException("Transaction is already closed")
+        distor = self.distributor
+        log = distor._undo
+        while len(log) > self.start:
+            entry = log.pop()
+            node, memo = entry[1], entry[2]
+            with node._mutex:
+                with distor._mutex:
+                    getattr(self, '_undo_' + entry[0])(*entry[1:])
+                    distor._recall(node, memo)
+                    if distor.journal is not None:
+                        distor.journal.recalled(node, memo)
+        self._close()
+
+    @staticmethod
+    def _restore(node, saved):
+        if all(node.resources.get(k, _ABSENT) == v
+               for k, v in saved.items()):
+            return
+        for k, v in saved.items():
+            if v is _ABSENT:
+                del node.resources[k]
+            else:
+                node.resources[k] = v
+        node._reward(saved.keys())
+        node._notify('_node_changed')
+
+    def _undo_attach(self, node, memo, load, saved):
+        node.detach(load.name)
+        self._restore(node, saved)
+
+    def _undo_detach(self, node, memo, load, saved):
+        node._commit(load, saved, restored=True)
+
+    def _undo_update(self, node, memo, saved):
+        self._restore(node, saved)
 
 
 class Distributor(object):
+    matrix = None
+    aversions = None
+    _mutex = _UNLOCKED
+    # Log of the open transactions, if any
+    _undo = None
+    journal = None
+    # Token of the snapshot last written or restored, which a journal
+    # follows
+    _snapshot_token = None
+
+    # A distributor's copies and pickles keep no lock of their own, but
+    # note whether it locked so that they lock again on being restored
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if state.pop('_mutex', _UNLOCKED) is not _UNLOCKED:
+            state['_locked'] = True
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        locked = state.pop('_locked', False)
+        self.__dict__.update(state)
+        for n in self.node_index.values():
+            n._watch(self)
+        if locked:
+            self.use_locking()
+
+    def _index(self, nodes):
+        self.aversions = AversionIndex()
+        # node name -> node
+        self.node_index = {}
+        # workload name -> node it is placed on
+        self.placements = {}
+        for n in nodes:
+            self._track(n)
 
-    def _attempt_placement(self, placer, load):
+    def _track(self, node):
+        self.node_index[node.name] = node
+        for w in node.assigned_workloads.values():
+            self.aversions.add(node, w)
+            self.placements[w.name] = node
+        node._watch(self)
+        if self._mutex is not _UNLOCKED and node._mutex is _UNLOCKED:
+            node._mutex = threading.RLock()
+
+    def _untrack(self, node):
+        del self.node_index[node.name]
+        for w in node.assigned_workloads.values():
+            del self.placements[w.name]
+        node._unwatch(self)
+
+    def _all_nodes(self):
+        return self.nodes
+
+    def _candidates(self, load):
+        return iter(())
+
+    # Candidates for a gang's load once `placed` of its loads are planned,
+    # on the scratch views of the nodes, by name
+    def _planned_candidates(self, load, placed, scratch):
+        return self._candidates(load)
+
+    # Called on the distributor that placed the load
+    def _placed(self, node, load):
         pass
 
-    def _attempt_assign_load(self, load):
-        attempts = [
-                lambda n, l: n.attempt_attach_amicable(l),
-                lambda n, l: n.attempt_attach(l)
-            ]
-        for attempt in attempts:
-            n = self._attempt_placement(attempt, load)
-            if not (n is None):
-                return n.name
+    # Records that the distributor placed the load, once it has
+    def _journal_placed(self, node, load):
+        if self.journal is not None:
+            self.journal.placed(node, load)
+
+    # Called on every distributor watching the node
+    def _node_attached(self, node, load):
+        self.aversions.add(node, load)
+        self.placements[load.name] = node
+        if self.matrix is not None:
+            self.matrix.update(node)
+        if self.journal is not None:
+            self.journal.attached(node, load)
+
+    def _node_detached(self, node, loads):
+        for l in loads:
+            self.aversions.remove(node, l)
+            if self.placements.get(l.name) is node:
+                del self.placements[l.name]
+        if self.matrix is not None:
+            self.matrix.update(node)
+        if self.journal is not None:
+            self.journal.detached(node, loads)
+
+    def _node_changed(self, node):
+        if self.matrix is not None:
+            self.matrix.update(node)
+        if self.journal is not None:
+            self.journal.changed(node)
+
+    # What the distributor's own bookkeeping holds about the node, beyond
+    # what follows from the node itself, so that a rolled back change can
+    # put it back exactly
+    def _memo(self, node):
+        return None
+
+    def _recall(self, node, memo):
+        pass
+
+    # Opens a Transaction over changes made through this distributor
+    def transaction(self):
+        return Transaction(self)
+
+    # Writes the nodes, placements and position of the distributor to a
+    # binary snapshot file, which Distributor.restore reads back. When
+    # journaling, the journal starts again after the snapshot.
+    def snapshot(self, path):
+        from pylighthouse.snapshot import write
+        write(self, path)
+
+    @staticmethod
+    def restore(path):
+        from pylighthouse.snapshot import read
+        return read(path)
+
+    # Opt in to journaling every change to the distributor's nodes and
+    # placements to an append-only file, synced to disk `batch` records
+    # at a time, so that pylighthouse.journal.recover can rebuild it from
+    # the last snapshot. Requires Python 3.
+    def use_journal(self, path, batch=256):
+        from pylighthouse.journal import Journal
+        with self._mutex:
+            self.journal = Journal(path, self._snapshot_token, batch)
+        return self
+
+    # Quantities of the given resources, to be restored on rollback
+    def _save(self, node, keys):
+        return dict((k, node.resources.get(k, _ABSENT)) for k in keys)
+
+    # Opt in to screening nodes through a columnar ResourceMatrix
+    # before attempting placement. Requires numpy. Given a number of
+    # workers, scans are spread over a pool of processes (or threads).
+    def use_matrix(self, workers=None, processes=True, shard_rows=4096):
+        if workers:
+            from pylighthouse.matrix import ParallelResourceMatrix
+            self.matrix = ParallelResourceMatrix(self._all_nodes(), workers,
+                                                 processes, shard_rows)
+        else:
+            from pylighthouse.matrix import ResourceMatrix
+            self.matrix = ResourceMatrix(self._all_nodes())
+        return self
+
+    # Opt in to placing and releasing from several threads at once.
+    # Each node gets its own lock, and the distributor a lock over its
+    # indexes; a node's lock is always taken before the distributor's.
+    def use_locking(self):
+        if self._mutex is _UNLOCKED:
+            self._mutex = threading.RLock()
+            for n in self._all_nodes():
+                if n._mutex is _UNLOCKED:
+                    n._mutex = threading.RLock()
+        return self
+
+    # Returns (node, used, amicable) for the first amicable candidate
+    # that fits, or else the first candidate that fits at all, or None.
+    # Each candidate's capacity is evaluated at most once. Given scratch
+    # views of nodes, by name, those are evaluated in place of the nodes.
+    # The load's plan is checked once here, or by the caller, and shared
+    # by every candidate.
+    def _choose(self, load, scratch=None, placed=0, plan=None):
+        if plan is None:
+            plan = load._compiled()
+        feasible = None
+        if self.matrix is not None:
+            feasible = self.matrix.screen(load)
+        averse = None
+        if self.aversions is not None:
+            averse = self.aversions.averse_nodes(load)
+        fallback = None
+        fallback_used = None
+        if scratch is None:
+            candidates = self._candidates(load)
+        else:
+            candidates = self._planned_candidates(load, placed, scratch)
+        for node in candidates:
+            if feasible is not None and not feasible(node):
+                continue
+            view = node
+            if scratch is not None:
+                view = scratch.get(node.name, node)
+            if averse is not None and view is node:
+                amicable = node.name not in averse
+            else:
+                amicable = not view._averse(plan)
+            if not amicable and fallback is not None:
+                continue
+            used = view._fit(load, plan)
+            if used is None:
+                continue
+            if amicable:
+                return (node, used, True)
+            fallback = node
+            fallback_used = used
+        if fallback is not None:
+            return (fallback, fallback_used, False)
         return None
 
+    # With locking, nodes are chosen under the distributor's lock but
+    # without holding any node's lock, so the choice may be stale by the
+    # time it is acted on. The node's fit is therefore checked again with
+    # its lock held, and the load committed under that same lock: this is
+    # the point at which the placement takes effect. If the check fails,
+    # another thread changed the node first, and the choice is made anew.
+    def _attempt_assign_load(self, load):
+        plan = load._compiled()
+        while True:
+            with self._mutex:
+                chosen = self._choose(load, plan=plan)
+            if chosen is None:
+                return None
+            node, used, amicable = chosen
+            if self._mutex is _UNLOCKED:
+                return self._assign(node, load, used, plan)
+            with node._mutex:
+                if self.node_index.get(node.name) is not node:
+                    continue
+                if amicable and node._averse(plan):
+                    continue
+                used = node._fit(load, plan)
+                if used is not None:
+                    return self._assign(node, load, used, plan)
+
+    def _assign(self, node, load, used, plan=None):
+        if self._undo is not None:
+            with node._mutex:
+                with self._mutex:
+                    memo = self._memo(node)
+                    saved = self._save(node, used)
+                    node._commit(load, used, plan=plan)
+                    self._placed(node, load)
+                    self._journal_placed(node, load)
+                    self._undo.append(('attach', node, memo, load, saved))
+            return node.name
+        node._commit(load, used, plan=plan)
+        with self._mutex:
+            self._placed(node, load)
+            self._journal_placed(node, load)
+        return node.name
+
+    # Returns the node with the given name, or None
+    def get_node(self, name):
+        return self.node_index.get(name)
+
+    # Returns the node the named workload is placed on, or None
+    def locate(self, workload_name):
+        return self.placements.get(workload_name)
+
+    # Detaches the named workloads from wherever they were placed.
+    # Returns a dictionary of workload name to the name of the node it
+    # was released from, or None if it was not placed.
+    def release(self, names):
+        results = {}
+        for name in names:
+            node = self.locate(name)
+            # The load may move between being located and detached when
+            # other threads release and place it
+            while node is not None and self._detach(node, name) is None:
+                node = self.locate(name)
+            results[name] = node.name if node is not None else None
+        return results
+
+    def _detach(self, node, name):
+        if self._undo is None:
+            return node.detach(name)
+        with node._mutex:
+            with self._mutex:
+                load = node.assigned_workloads.get(name)
+                if load is None:
+                    return None
+                memo = self._memo(node)
+                saved = self._save(node, load.requirements)
+                node.detach(name)
+                self._undo.append(('detach', node, memo, load, saved))
+                return load
+
+    # Adds the node to, or removes it from, the distributor's own
+    # ordering of nodes; a list unless overridden
+    def _insert(self, node):
+        self.nodes.append(node)
+
+    # Returns the position the node was removed from
+    def _delete(self, node):
+        for i, n in enumerate(self.nodes):
+            if n is node:
+                del self.nodes[i]
+                return i
+
+    def add_node(self, node):
+        self._fixed_membership()
+        with self._mutex:
+            if node.name in self.node_index:
+                raise LighthouseException(
+                    "Node `{0}` is already present".format(node.name))
+            self._insert(node)
+            self._track(node)
+            if self.matrix is not None:
+                self.matrix.add(node)
+            if self.journal is not None:
+                self.journal.added(node)
+
+    # Removes the named node. If workloads are still placed on it, they
+    # are detached and returned when draining; otherwise it is an error.
+    # Returns None if there is no such node.
+    def remove_node(self, name, drain=False):
+        self._fixed_membership()
+        node = self.node_index.get(name)
+        if node is None:
+            return None
+        with node._mutex:
+            with self._mutex:
+                if self.node_index.get(name) is not node:
+                    return None
+                orphans = list(node.assigned_workloads.values())
+                if orphans:
+                    if not drain:
+                        raise LighthouseException(
+                            "Node `{0}` still has workloads placed on "
+                            "it".format(name))
+                    node.detach_all()
+                if self.matrix is not None:
+                    self.matrix.remove(node)
+                self._untrack(node)
+                self._delete(node)
+                if self.journal is not None:
+                    self.journal.removed(node)
+                return orphans
+
+    # Membership cannot change while a transaction is open
+    def _fixed_membership(self):
+        if self._undo is not None:
+            raise LighthouseException(
+                "Nodes cannot be added or removed during a transaction")
+
+    # Sets the named node's remaining resources to the given quantities
+    def update_resources(self, name, resources):
+        node = self.node_index.get(name)
+        if node is None:
+            raise LighthouseException(
+                "No node named `{0}`".format(name))
+        if self._undo is None:
+            node.update_resources(resources)
+            return
+        with node._mutex:
+            with self._mutex:
+                memo = self._memo(node)
+                saved = self._save(node, resources)
+                node.update_resources(resources)
+                self._undo.append(('update', node, memo, saved))
+
+    # Returns loads in the order they should be placed
+    def _arrange(self, loads):
+        return loads
+
+    # Yields (workload name, node name or None) in placement order
+    def _assign_each(self, loads):
+        loads = self._arrange(loads)
+        # Batched masks belong to one caller, so are not used with locking
+        if self.matrix is not None and self._mutex is _UNLOCKED:
+            loads = list(loads)
+            self.matrix.begin(loads)
+        try:
+            for l in loads:
+                yield (l.name, self._attempt_assign_load(l))
+        finally:
+            if self.matrix is not None and self._mutex is _UNLOCKED:
+                self.matrix.end()
+
     def attempt_assign_loads(self, loads):
         results = {}
-        for l in loads:
-            results[l.name] = self._attempt_assign_load(l)
+        for name, node_name in self._assign_each(loads):
+            results[name] = node_name
         return results
 
+    # Returns [(node, load)] placing every load, as if one after the
+    # other, or None if any of them cannot be placed. Nodes are only
+    # read: what the gang takes from them is kept in scratch views.
+    def _plan_gang(self, loads):
+        scratch = {}
+        plan = []
+        for load in loads:
+            chosen = self._choose(load, scratch, len(plan))
+            if chosen is None:
+                return None
+            node, used, amicable = chosen
+            if node.name not in scratch:
+                scratch[node.name] = _ScratchNode(node)
+            scratch[node.name]._commit(load, used)
+            plan.append((node, load))
+        return plan
+
+    # Places every load or none of them. The placement is planned first
+    # without changing any node, so a gang which does not fit costs no
+    # changes to undo. Returns a dictionary like attempt_assign_loads,
+    # with every node name None if the gang was not placed.
+    def attempt_assign_gang(self, loads):
+        loads = list(self._arrange(loads))
+        while True:
+            with self._mutex:
+                plan = self._plan_gang(loads)
+            if plan is None:
+                return dict((l.name, None) for l in loads)
+            done = []
+            for node, load in plan:
+                with node._mutex:
+                    used = None
+                    compiled = load._compiled()
+                    if self.node_index.get(node.name) is node:
+                        used = node._fit(load, compiled)
+                    if used is None:
+                        break
+                    self._assign(node, load, used, compiled)
+                    done.append(load.name)
+            else:
+                return dict((l.name, n.name) for n, l in plan)
+            # Only reached when other threads changed a planned node
+            # between planning and commit: undo and plan again
+            self.release(done)
+
+    # How many loads assign_stream arranges together by default
+    stream_window = 1
+
+    # Places loads from any iterable as they arrive, yielding
+    # (workload name, node name or None) for each. At most `window` loads
+    # are buffered and arranged together, as attempt_assign_loads would.
+    def assign_stream(self, loads, window=None):
+        if window is None:
+            window = self.stream_window
+        buffered = []
+        for l in loads:
+            buffered.append(l)
+            if len(buffered) >= window:
+                for result in self._assign_each(buffered):
+                    yield result
+                buffered = []
+        if buffered:
+            for result in self._assign_each(buffered):
+                yield result
+
 
 class PrioritizedDistributor(Distributor):
     def __init__(self, nodes):
         self.nodes = nodes
+        self._index(nodes)
 
     @staticmethod
     def from_list(nodes):
         return PrioritizedDistributor(nodes)
 
-    def _attempt_placement(self, placer, load):
-        for i in range(0, len(self.nodes)):
-            result = placer(self.nodes[i], load)
-            if result:
-                return self.nodes[i]
-        return None
+    def _candidates(self, load):
+        return iter(self.nodes)
 
 
 class RoundRobinDistributor(Distributor):
+    headroom = None
+
     def __init__(self, nodes):
         self.nodes = nodes
         self.next = 0
+        self._index(nodes)
 
     @staticmethod
     def from_list(nodes):
         return RoundRobinDistributor(nodes)
 
-    def _attempt_placement(self, placer, load):
+    # Opt in to skipping, in the rotation, nodes which have none left of a
+    # resource the load needs. Placements are the same as without.
+    def use_headroom_index(self):
+        self.headroom = HeadroomIndex(self.nodes)
+        return self
+
+    def _candidates(self, load):
+        if self.headroom is not None:
+            positions = self.headroom.scarcest(load)
+            if positions is not None:
+                if not positions:
+                    return iter(())
+                start = self.headroom.at[self.nodes[self.next].name]
+                return self.headroom.following(positions, start)
+        return self._rotation(self.next)
+
+    # Each placement moves the cursor on by one
+    def _planned_candidates(self, load, placed, scratch):
+        return self._rotation(self.next + placed)
+
+    def _rotation(self, start):
         size = len(self.nodes)
-        index = 0
         for i in range(0, size):
-            index = (i + self.next) % size
-            result = placer(self.nodes[index], load)
-            if result:
-                self.next = (self.next + 1) % size
-                return self.nodes[index]
-        return None
+            yield self.nodes[(i + start) % size]
+
+    def _placed(self, node, load):
+        super(RoundRobinDistributor, self)._placed(node, load)
+        self.next = (self.next + 1) % len(self.nodes)
+
+    def _memo(self, node):
+        return self.next
+
+    def _recall(self, node, memo):
+        self.next = memo
+
+    def _insert(self, node):
+        super(RoundRobinDistributor, self)._insert(node)
+        if self.headroom is not None:
+            self.headroom.add(node)
+
+    # Keeps the cursor on the same node as it was on, if that is still
+    # present, or else on the one which took its place
+    def _delete(self, node):
+        i = super(RoundRobinDistributor, self)._delete(node)
+        if i < self.next:
+            self.next = self.next - 1
+        if self.next >= len(self.nodes):
+            self.next = 0
+        if self.headroom is not None:
+            self.headroom.remove(node)
+        return i
+
+    def _node_attached(self, node, load):
+        super(RoundRobinDistributor, self)._node_attached(node, load)
+        if self.headroom is not None:
+            self.headroom.update(node, load.requirements.keys())
+
+    def _node_detached(self, node, loads):
+        super(RoundRobinDistributor, self)._node_detached(node, loads)
+        if self.headroom is not None:
+            keys = set()
+            for l in loads:
+                keys.update(l.requirements.keys())
+            self.headroom.update(node, keys)
+
+    def _node_changed(self, node):
+        super(RoundRobinDistributor, self)._node_changed(node)
+        if self.headroom is not None:
+            self.headroom.update(node)
 
 
 class LighthouseRubricException(LighthouseException):
@@ -222,17 +1309,33 @@ class Rubric(object):
         self.rubric = rubric
         self.keys_rubric = set(self.rubric.keys())
         self.size = len(self.keys_rubric)
+        self.weights = list(self.rubric.items())
 
     def score(self, parts):
-        keys_parts = set(parts.keys())
-        shared_keys = self.keys_rubric.intersection(keys_parts)
-
         result = 0
-        for k in shared_keys:
-            result = result + (self.rubric[k] * parts[k])
-
+        # Walk whichever of the two is smaller
+        if len(parts) < self.size:
+            for k, v in parts.items():
+                w = self.rubric.get(k)
+                if w is not None:
+                    result = result + (w * v)
+        else:
+            for k, w in self.weights:
+                if k in parts:
+                    result = result + (w * parts[k])
         return result
 
+    # The score of some parts after other parts scoring contribution were
+    # taken away from them, or None if it has to be recomputed in full.
+    # Only integers are deducted, since they are exact: a float score
+    # would drift from the one computed afresh, and a load which exactly
+    # fits what is left of a node would then be turned away from it.
+    @staticmethod
+    def deduct(score, contribution):
+        if isinstance(score, int) and isinstance(contribution, int):
+            return score - contribution
+        return None
+
     # Intended for use with BinPackDistributor
     # sort workloads biggest workload first
     def sort_workloads(self, loads):
@@ -242,50 +1345,265 @@ class Rubric(object):
 
 
 class BinPackDistributor(Distributor):
+    capacities = None
+    # Streamed loads are placed biggest first within windows of this size
+    stream_window = 1024
 
-    def __init__(self, rubric, nodes):
+    # Scores may be given by node name, as when restoring a snapshot,
+    # rather than computed from the rubric
+    def __init__(self, rubric, nodes, scores=None):
         self.rubric = rubric
         self.scores = {}
         self.nodes = SortedDict({})
         for n in nodes:
-            sc = self.rubric.score(n.resources)
+            if scores is not None:
+                sc = scores[n.name]
+            else:
+                sc = self.rubric.score(n.resources)
             self.nodes[(sc, n.name)] = n
             self.scores[n.name] = sc
+        self._index(self.nodes.values())
 
     @staticmethod
     def from_list(rubric, nodes):
         return BinPackDistributor(Rubric(rubric), nodes)
 
-    def _attempt_placement(self, placer, load):
-        found_node = None
-        found_name = None
-        found_old_score = None
-        for (nscore, name), node in self.nodes.items():
-            if nscore < load[0]:
-                continue
-            result = placer(node, load[1])
-            if result:
-                found_node = node
-                found_name = name
-                found_old_score = nscore
-                break
-        if not (found_node is None):
-            new_score = self.rubric.score(found_node.resources)
-            self.scores[found_name] = new_score
-            del self.nodes[(found_old_score, found_name)]
-            self.nodes[(new_score, found_name)] = found_node
-            return found_node
-        return None
+    def _all_nodes(self):
+        return self.nodes.values()
 
-    def attempt_assign_loads(self, loads):
-        annotated_loads = []
+    def _insert(self, node):
+        sc = self.rubric.score(node.resources)
+        self.nodes[(sc, node.name)] = node
+        self.scores[node.name] = sc
+        if self.capacities is not None:
+            self.capacities.update(node)
+
+    def _delete(self, node):
+        del self.nodes[(self.scores.pop(node.name), node.name)]
+        if self.capacities is not None:
+            self.capacities.remove(node)
+
+    # Opt in to pruning candidates which lack room in the load's
+    # scarcest resource before walking them in score order
+    def use_capacity_index(self):
+        self.capacities = CapacityIndex(self.nodes.values())
+        return self
+
+    def _candidates(self, load):
+        # (load_score,) sorts before every (load_score, name) key
+        bound = (self.rubric.score(load.requirements),)
+        if self.capacities is not None:
+            scarcest = self.capacities.scarcest(load)
+            if scarcest is not None and scarcest[2] < \
+                    len(self.nodes) - self.nodes.bisect_left(bound):
+                key, amount, count = scarcest
+                keys = sorted((self.scores[name], name) for name in
+                              self.capacities.fitting(key, amount))
+                start = bisect.bisect_left(keys, bound)
+                return (self.nodes[k] for k in keys[start:])
+        return (self.nodes[k] for k in self.nodes.irange(minimum=bound))
+
+    # Nodes with some of the gang planned on them are placed by their
+    # scores with it, which are exactly those a node would be rescored
+    # to, among the others by their scores as they are
+    def _planned_candidates(self, load, placed, scratch):
+        if not scratch:
+            return self._candidates(load)
+        bound = (self.rubric.score(load.requirements),)
+        planned = sorted(k for k in ((self.rubric.score(view.resources), name)
+                                     for name, view in scratch.items())
+                         if k >= bound)
+        others = ((self.scores[n.name], n.name)
+                  for n in self._candidates(load) if n.name not in scratch)
+        return (self.node_index[name]
+                for score, name in heapq.merge(planned, others))
+
+    def _node_attached(self, node, load):
+        super(BinPackDistributor, self)._node_attached(node, load)
+        self._rescore(node, self.rubric.score(load.requirements))
+        if self.capacities is not None:
+            self.capacities.update(node, load.requirements.keys())
+
+    def _node_detached(self, node, loads):
+        super(BinPackDistributor, self)._node_detached(node, loads)
+        contribution = 0
         for l in loads:
-            load_score = self.rubric.score(l.requirements)
-            annotated_loads.append((load_score, l))
-        annotated_loads = sorted(annotated_loads,
-                                 key=(lambda x: x[0]),
-                                 reverse=True)
-        results = {}
-        for l in annotated_loads:
-            results[l[1].name] = self._attempt_assign_load(l)
-        return results
+            contribution = contribution - self.rubric.score(l.requirements)
+        self._rescore(node, contribution)
+        if self.capacities is not None:
+            keys = set()
+            for l in loads:
+                keys.update(l.requirements.keys())
+            self.capacities.update(node, keys)
+
+    def _node_changed(self, node):
+        super(BinPackDistributor, self)._node_changed(node)
+        self._rescore(node)
+        if self.capacities is not None:
+            self.capacities.update(node)
+
+    def _memo(self, node):
+        return self.scores[node.name]
+
+    def _recall(self, node, memo):
+        self._rescore(node, score=memo)
+
+    # Moves the node to its new score, found by deducting the scoring
+    # contribution of what was taken from it when that is given
+    def _rescore(self, node, contribution=None, score=None):
+        old_score = self.scores[node.name]
+        new_score = score
+        if new_score is None and contribution is not None:
+            new_score = self.rubric.deduct(old_score, contribution)
+        if new_score is None:
+            new_score = self.rubric.score(node.resources)
+        self.scores[node.name] = new_score
+        del self.nodes[(old_score, node.name)]
+        self.nodes[(new_score, node.name)] = node
+
+    def _arrange(self, loads):
+        return self.rubric.sort_workloads(loads)
+
+
+class VectorBinPackDistributor(BinPackDistributor):
+    '''
+    Best fit by rubric score, like BinPackDistributor, but only ever visits
+    nodes whose resources dominate the load's requirement vector. These are
+    found through per-resource capacity trees, starting from the load's
+    scarcest resource.
+    '''
+
+    def __init__(self, rubric, nodes, scores=None):
+        super(VectorBinPackDistributor, self).__init__(rubric, nodes, scores)
+        self.use_capacity_index()
+
+    @staticmethod
+    def from_list(rubric, nodes):
+        return VectorBinPackDistributor(Rubric(rubric), nodes)
+
+    def _dominates(self, name, load):
+        have = self.capacities.indexed[name]
+        for k, v in load.requirements.items():
+            if k not in have:
+                return False
+            if k not in load.immunities and have[k] < v:
+                return False
+        return True
+
+    def _candidates(self, load):
+        scarcest = self.capacities.scarcest(load)
+        if scarcest is None:
+            return super(VectorBinPackDistributor, self)._candidates(load)
+        bound = (self.rubric.score(load.requirements),)
+        key, amount, count = scarcest
+        keys = sorted((self.scores[name], name)
+                      for name in self.capacities.fitting(key, amount)
+                      if self._dominates(name, load))
+        start = bisect.bisect_left(keys, bound)
+        return (self.nodes[k] for k in keys[start:])
+
+
+class LeastLoadedDistributor(Distributor):
+    '''
+    Spreads workloads by placing each on the least loaded node that can
+    take it. A node's load is its dominant share, as in Dominant Resource
+    Fairness: the largest fraction of any one resource's capacity that its
+    workloads take up. Only the named resources count, if any are named.
+
+    Nodes are kept sorted by share, and a node is moved only when a
+    workload is attached to or detached from it, or its resources change.
+    '''
+
+    # Capacities and shares may be given by node name, as when restoring a
+    # snapshot, rather than measured from the nodes
+    def __init__(self, nodes, resources=None, totals=None, shares=None):
+        self.resources = None if resources is None else set(resources)
+        # node name -> resource -> quantity the node had before any of
+        # its workloads were attached
+        self.totals = {}
+        self.shares = {}
+        self.nodes = SortedDict({})
+        for n in nodes:
+            if totals is not None:
+                self.totals[n.name] = totals[n.name]
+                sh = shares[n.name]
+            else:
+                self._measure(n)
+                sh = self._share(n)
+            self.nodes[(sh, n.name)] = n
+            self.shares[n.name] = sh
+        self._index(self.nodes.values())
+
+    @staticmethod
+    def from_list(nodes, resources=None):
+        return LeastLoadedDistributor(nodes, resources)
+
+    def _all_nodes(self):
+        return self.nodes.values()
+
+    def _measure(self, node):
+        capacity = dict(node.resources)
+        for w in node.assigned_workloads.values():
+            for k, v in w.requirements.items():
+                if k in capacity:
+                    capacity[k] = capacity[k] + v
+        self.totals[node.name] = dict(
+            (k, v) for k, v in capacity.items()
+            if v > 0 and not math.isinf(v) and
+            (self.resources is None or k in self.resources))
+
+    def _share(self, node):
+        share = 0
+        resources = node.resources
+        for k, v in self.totals[node.name].items():
+            used = (v - resources.get(k, v)) / float(v)
+            if used > share:
+                share = used
+        return share
+
+    def _insert(self, node):
+        self._measure(node)
+        sh = self._share(node)
+        self.nodes[(sh, node.name)] = node
+        self.shares[node.name] = sh
+
+    def _delete(self, node):
+        del self.nodes[(self.shares.pop(node.name), node.name)]
+        del self.totals[node.name]
+
+    def _candidates(self, load):
+        return iter(self.nodes.values())
+
+    # Nodes with some of the gang planned on them are placed by their
+    # shares with it, among the others by their shares as they are
+    def _planned_candidates(self, load, placed, scratch):
+        if not scratch:
+            return self._candidates(load)
+        planned = sorted((self._share(view), name)
+                         for name, view in scratch.items())
+        others = (k for k in self.nodes.keys() if k[1] not in scratch)
+        return (self.node_index[name]
+                for share, name in heapq.merge(planned, others))
+
+    def _reshare(self, node):
+        old_share = self.shares[node.name]
+        new_share = self._share(node)
+        if new_share != old_share:
+            self.shares[node.name] = new_share
+            del self.nodes[(old_share, node.name)]
+            self.nodes[(new_share, node.name)] = node
+
+    def _node_attached(self, node, load):
+        super(LeastLoadedDistributor, self)._node_attached(node, load)
+        self._reshare(node)
+
+    def _node_detached(self, node, loads):
+        super(LeastLoadedDistributor, self)._node_detached(node, loads)
+        self._reshare(node)
+
+    # Setting a node's remaining resources sets its capacity to them plus
+    # what its workloads already take
+    def _node_changed(self, node):
+        super(LeastLoadedDistributor, self)._node_changed(node)
+        self._measure(node)
+        self._reshare(node)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""Binary snapshots of distributor state. Requires Python 3."""
+
+import contextlib
+import gc
+import json
+import mmap
+import os
+import struct
+import sys
+import uuid
+from array import array
+
+from pylighthouse.compact import CompactNode, CompactWorkload, ResourceVector
+from pylighthouse.pylighthouse import BinPackDistributor, \
+    LeastLoadedDistributor, LighthouseException, Node, \
+    PrioritizedDistributor, RoundRobinDistributor, Rubric, \
+    VectorBinPackDistributor, Workload, _UNLOCKED
+
+MAGIC = b'PLHSNAP\x00'
+VERSION = 1
+
+# Magic, version and number of sections, followed by the offset and length
+# in bytes of each section. Sections start on 8 byte boundaries.
+_HEADER = struct.Struct('<8sQQ')
+
+# Names in the string table are indexed by position. A node's or workload's
+# quantities are the keys and values between consecutive entries of its
+# spans; ints flags the quantities which were integers. Scores hold each
+# node's bin-pack score or least-loaded share, and totals a least-loaded
+# node's capacities.
+_SECTIONS = (
+    'meta',
+    'strings',
+    'node_names',
+    'node_spans',
+    'node_keys',
+    'node_values',
+    'node_ints',
+    'scores',
+    'total_spans',
+    'total_keys',
+    'total_values',
+    'total_ints',
+    'load_names',
+    'load_nodes',
+    'load_spans',
+    'load_keys',
+    'load_values',
+    'load_ints',
+    'immunity_spans',
+    'immunities',
+    'group_spans',
+    'groups',
+)
+
+_KINDS = dict((cls.__name__, cls) for cls in (
+    PrioritizedDistributor, RoundRobinDistributor, BinPackDistributor,
+    VectorBinPackDistributor, LeastLoadedDistributor))
+
+
+class _Strings(object):
+    '''
+    Table of the distinct names in a snapshot, stored NUL separated so that
+    they are all decoded in one go.
+    '''
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def id(self, name):
+        found = self.ids.get(name)
+        if found is not None:
+            return found
+        if not isinstance(name, str) or '\x00' in name:
+            raise LighthouseException(
+                "Cannot snapshot the name `{0!r}`".format(name))
+        self.ids[name] = len(self.names)
+        self.names.append(name)
+        return self.ids[name]
+
+    def encode(self):
+        return '\x00'.join(self.names).encode('utf-8')
+
+
+def _quantities(mapping, strings, keys, values, ints):
+    for k, v in mapping.items():
+        keys.append(strings.id(k))
+        values.append(v)
+        ints.append(isinstance(v, int) and float(v) == v)
+
+
+def _names(names, strings, ids, spans):
+    ids.extend(strings.id(n) for n in names)
+    spans.append(len(ids))
+
+
+# Holds every node's lock, then the distributor's, when locking is on
+@contextlib.contextmanager
+def _frozen(distor, nodes):
+    with contextlib.ExitStack() as stack:
+        if distor._mutex is not _UNLOCKED:
+            for n in nodes:
+                stack.enter_context(n._mutex)
+            stack.enter_context(distor._mutex)
+        yield
+
+
+def write(distor, path):
+    '''
+    Write the distributor's nodes, placements, round-robin position,
+    bin-pack scores and least-loaded capacities and shares to ``path``,
+    replacing it atomically.
+
+    Each snapshot gets a fresh token. A distributor's journal is started
+    again after the snapshot, under that token, before anything else can
+    change; should the process die in between, the old journal's token no
+    longer matches and recovery skips it.
+    '''
+    kind = type(distor).__name__
+    if _KINDS.get(kind) is not type(distor):
+        raise LighthouseException("Cannot snapshot a `{0}`".format(kind))
+    nodes = list(distor._all_nodes())
+    token = uuid.uuid4().hex
+    with _frozen(distor, nodes):
+        sections = _encode(distor, kind, nodes, token)
+        _write_sections(sections, path)
+        distor._snapshot_token = token
+        if distor.journal is not None:
+            distor.journal.restart(token)
+
+
+def _write_sections(sections, path):
+    offsets = []
+    at = _HEADER.size + 16 * len(sections)
+    for data in sections:
+        at = (at + 7) & ~7
+        offsets.append(at)
+        at += len(data)
+    partial = path + '.partial'
+    with open(partial, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(sections)))
+        for offset, data in zip(offsets, sections):
+            f.write(struct.pack('<QQ', offset, len(data)))
+        for offset, data in zip(offsets, sections):
+            f.write(b'\x00' * (offset - f.tell()))
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+
+
+def _encode(distor, kind, nodes, token):
+    strings = _Strings()
+    node_names = array('Q')
+    node_spans = array('Q', [0])
+    node_keys = array('Q')
+    node_values = array('d')
+    node_ints = array('B')
+    load_names = array('Q')
+    load_nodes = array('Q')
+    load_spans = array('Q', [0])
+    load_keys = array('Q')
+    load_values = array('d')
+    load_ints = array('B')
+    immunity_spans = array('Q', [0])
+    immunities = array('Q')
+    group_spans = array('Q', [0])
+    groups = array('Q')
+    for i, n in enumerate(nodes):
+        node_names.append(strings.id(n.name))
+        _quantities(n.resources, strings, node_keys, node_values, node_ints)
+        node_spans.append(len(node_keys))
+        for w in n.assigned_workloads.values():
+            load_names.append(strings.id(w.name))
+            load_nodes.append(i)
+            _quantities(w.requirements, strings, load_keys, load_values,
+                        load_ints)
+            load_spans.append(len(load_keys))
+            _names(w.immunities, strings, immunities, immunity_spans)
+            _names(w.aversion_groups, strings, groups, group_spans)
+    meta = {
+        'kind': kind,
+        'byteorder': sys.byteorder,
+        'compact': bool(nodes) and isinstance(nodes[0], CompactNode),
+        'cursor': getattr(distor, 'next', 0),
+        'headroom_index': getattr(distor, 'headroom', None) is not None,
+        'token': token,
+    }
+    scores = array('d')
+    total_spans = array('Q', [0])
+    total_keys = array('Q')
+    total_values = array('d')
+    total_ints = array('B')
+    if isinstance(distor, BinPackDistributor):
+        meta['rubric'] = distor.rubric.rubric
+        meta['capacity_index'] = distor.capacities is not None
+        scores.extend(distor.scores[n.name] for n in nodes)
+    if isinstance(distor, LeastLoadedDistributor):
+        if distor.resources is not None:
+            meta['resources'] = sorted(distor.resources)
+        scores.extend(distor.shares[n.name] for n in nodes)
+        for n in nodes:
+            _quantities(distor.totals[n.name], strings, total_keys,
+                        total_values, total_ints)
+            total_spans.append(len(total_keys))
+    return [json.dumps(meta).encode('utf-8'), strings.encode(),
+            node_names.tobytes(), node_spans.tobytes(), node_keys.tobytes(),
+            node_values.tobytes(), node_ints.tobytes(), scores.tobytes(),
+            total_spans.tobytes(), total_keys.tobytes(),
+            total_values.tobytes(), total_ints.tobytes(),
+            load_names.tobytes(), load_nodes.tobytes(), load_spans.tobytes(),
+            load_keys.tobytes(), load_values.tobytes(), load_ints.tobytes(),
+            immunity_spans.tobytes(), immunities.tobytes(),
+            group_spans.tobytes(), groups.tobytes()]
+
+
+def _decode(m):
+    magic, version, count = _HEADER.unpack_from(m, 0)
+    if magic != MAGIC:
+        raise LighthouseException("Not a pylighthouse snapshot")
+    if version != VERSION or count != len(_SECTIONS):
+        raise LighthouseException(
+            "Unsupported snapshot version {0}".format(version))
+    table = struct.unpack_from('<{0}Q'.format(2 * count), m, _HEADER.size)
+    formats = {'meta': None, 'strings': None, 'node_values': 'd',
+               'scores': 'd', 'total_values': 'd', 'load_values': 'd',
+               'node_ints': 'B', 'total_ints': 'B', 'load_ints': 'B'}
+    found = {}
+    with memoryview(m) as view:
+        for i, name in enumerate(_SECTIONS):
+            offset, length = table[2 * i], table[2 * i + 1]
+            with view[offset:offset + length] as part:
+                fmt = formats.get(name, 'Q')
+                if fmt is None:
+                    found[name] = bytes(part)
+                else:
+                    with part.cast(fmt) as typed:
+                        found[name] = typed.tolist()
+    return found
+
+
+def read(path):
+    '''
+    Rebuild the distributor written to ``path`` by ``write``, without
+    placing or scoring anything again.
+    '''
+    # Nothing built here is garbage, so collecting while building the
+    # objects only costs repeated walks over them
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        return _read(path)
+    finally:
+        if collecting:
+            gc.enable()
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            s = _decode(m)
+    meta = json.loads(s['meta'].decode('utf-8'))
+    if meta['byteorder'] != sys.byteorder:
+        raise LighthouseException(
+            "Snapshot was written on a {0} endian machine".format(
+                meta['byteorder']))
+    names = s['strings'].decode('utf-8').split('\x00')
+
+    # Whole columns are converted at once, then sliced per row
+    def quantities(prefix):
+        keys = [names[k] for k in s[prefix + '_keys']]
+        values = [int(v) if i else v for v, i in
+                  zip(s[prefix + '_values'], s[prefix + '_ints'])]
+        spans = s[prefix + '_spans']
+        return [dict(zip(keys[a:b], values[a:b]))
+                for a, b in zip(spans, spans[1:])]
+
+    def named(spans, ids):
+        ids = [names[i] for i in s[ids]]
+        spans = s[spans]
+        return [ids[a:b] for a, b in zip(spans, spans[1:])]
+
+    compact = meta['compact']
+    load_type = CompactWorkload if compact else Workload
+    node_type = CompactNode if compact else Node
+    assigned = [None] * len(s['node_names'])
+    rows = zip(s['load_names'], s['load_nodes'], quantities('load'),
+               named('immunity_spans', 'immunities'),
+               named('group_spans', 'groups'))
+    for name, node, requirements, immunities, groups in rows:
+        name = names[name]
+        if compact:
+            requirements = ResourceVector(requirements)
+        w = load_type._assemble(name, requirements, immunities, groups)
+        if assigned[node] is None:
+            assigned[node] = {}
+        assigned[node][name] = w
+
+    nodes = [node_type(names[name], resources, workloads)
+             for name, resources, workloads in
+             zip(s['node_names'], quantities('node'), assigned)]
+
+    cls = _KINDS[meta['kind']]
+    if issubclass(cls, BinPackDistributor):
+        scores = dict(zip((n.name for n in nodes), s['scores']))
+        distor = cls(Rubric(meta['rubric']), nodes, scores)
+        if meta['capacity_index'] and distor.capacities is None:
+            distor.use_capacity_index()
+    elif issubclass(cls, LeastLoadedDistributor):
+        node_names = [n.name for n in nodes]
+        distor = cls(nodes, meta.get('resources'),
+                     dict(zip(node_names, quantities('total'))),
+                     dict(zip(node_names, s['scores'])))
+    else:
+        distor = cls(nodes)
+        if isinstance(distor, RoundRobinDistributor):
+            distor.next = meta['cursor']
+            if meta.get('headroom_index'):
+                distor.use_headroom_index()
+    distor._snapshot_token = meta.get('token')
+    return distor
@@ -22,6 +22,12 @@ setup_requirements = ['pytest-runner', ]
 
 test_requirements = ['pytest', ]
 
+extra_requirements = {
+    'matrix': ['numpy'],
+    'msgpack': ['msgpack'],
+    'arrow': ['pyarrow'],
+}
+
 setup(
     author="Daniel Jay Haskin",
     author_email='djhaskin987@gmail.com',
@@ -40,6 +46,7 @@ setup(
     ],
     description="Helps workloads find safe harbor.",
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="Apache Software License 2.0",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+'''
+Tests for `pylighthouse.aio`.
+'''
+
+import asyncio
+
+import pylighthouse.pylighthouse as lighthouse
+from pylighthouse.aio import AsyncDistributor
+
+
+class CountingDistributor(lighthouse.PrioritizedDistributor):
+    def __init__(self, nodes):
+        super(CountingDistributor, self).__init__(nodes)
+        self.batches = []
+
+    def attempt_assign_loads(self, loads):
+        self.batches.append(len(loads))
+        return super(CountingDistributor, self).attempt_assign_loads(loads)
+
+
+def make_nodes():
+    return lighthouse.Node.from_list([
+        {
+            "name": "node-%d" % i,
+            "resources": {
+                "slot": 10
+            }
+        } for i in range(3)])
+
+
+def test_coalesces_submissions():
+    distor = CountingDistributor(make_nodes())
+    front = AsyncDistributor(distor, window=0.05)
+    loads = [lighthouse.Workload("load-%d" % i, {"slot": 1})
+             for i in range(25)]
+
+    async def main():
+        return await asyncio.gather(*[front.assign(l) for l in loads])
+
+    try:
+        results = asyncio.run(main())
+    finally:
+        front.close()
+    assert distor.batches == [25]
+    assert results == ["node-0"] * 10 + ["node-1"] * 10 + ["node-2"] * 5
+
+
+def test_max_batch_and_release():
+    distor = CountingDistributor(make_nodes())
+    # Full batches flush at once, long before the window is up
+    front = AsyncDistributor(distor, window=60, max_batch=4)
+    # while a lone load waits out a short window
+    trailing = AsyncDistributor(distor, window=0.01, max_batch=4)
+    loads = [lighthouse.Workload("load-%d" % i, {"slot": 4})
+             for i in range(8)]
+
+    async def main():
+        placed = await front.assign_loads(loads)
+        released = await front.release(["load-0", "load-7"])
+        again = await trailing.assign_loads(loads[7:])
+        return placed, released, again
+
+    try:
+        placed, released, again = asyncio.run(main())
+    finally:
+        front.close()
+        trailing.close()
+    assert distor.batches == [4, 4, 1]
+    assert placed["load-6"] is None
+    assert released == {"load-0": "node-0", "load-7": None}
+    assert again == {"load-7": "node-0"}
+
+
+def test_errors_reach_every_caller():
+    class Broken(lighthouse.PrioritizedDistributor):
+        def attempt_assign_loads(self, loads):
+            raise lighthouse.LighthouseException("broken")
+
+    front = AsyncDistributor(Broken(make_nodes()), window=0.01)
+
+    async def main():
+        return await asyncio.gather(
+            front.assign(lighthouse.Workload("a", {})),
+            front.assign(lighthouse.Workload("b", {})),
+            return_exceptions=True)
+
+    try:
+        results = asyncio.run(main())
+    finally:
+        front.close()
+    assert [type(r) for r in results] == [lighthouse.LighthouseException] * 2
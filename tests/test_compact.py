@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+'''
+Tests for `pylighthouse.compact`.
+'''
+
+import copy
+import pickle
+
+import pytest
+
+import pylighthouse.pylighthouse as lighthouse
+from pylighthouse.compact import CompactNode, CompactWorkload, ResourceVector
+
+
+def test_resource_vector_mapping():
+    schema = lighthouse.ResourceSchema()
+    v = ResourceVector({"cpu": 4, "tag": 0}, schema)
+    w = ResourceVector({"mem": 2}, schema)
+    assert schema.names == ["cpu", "tag", "mem"]
+    assert v == {"cpu": 4, "tag": 0}
+    assert {"mem": 2} == w
+    assert "tag" in v
+    assert "mem" not in v
+    assert len(v) == 2
+    with pytest.raises(KeyError):
+        v["mem"]
+    v["mem"] = -float("inf")
+    del v["tag"]
+    assert sorted(v.keys()) == ["cpu", "mem"]
+    assert len(v.values) == 2
+
+
+def test_resource_vector_sparse():
+    '''
+    A vector only stores the names it holds, however many the schema has
+    interned, and keeps integers as integers as names come and go
+    '''
+    schema = lighthouse.ResourceSchema()
+    for i in range(20000):
+        schema.intern("tag-%d" % i)
+    v = ResourceVector({"tag-19999": 1, "tag-5": 2.5}, schema)
+    assert len(v.values) == 2
+    assert v.ints.bit_length() <= 2
+    v["tag-7"] = 3
+    v["tag-0"] = 0.5
+    v["tag-9"] = 4
+    assert list(v) == ["tag-0", "tag-5", "tag-7", "tag-9", "tag-19999"]
+    del v["tag-7"]
+    assert repr(v) == repr({"tag-0": 0.5, "tag-5": 2.5, "tag-9": 4,
+                            "tag-19999": 1})
+    v["tag-5"] = 6
+    assert repr(v["tag-5"]) == "6"
+
+
+def test_compact_from_dict_and_repr():
+    n = CompactNode.from_dict({
+        "name": "node",
+        "resources": {
+            "cpu": 2.5,
+            "mem": 8.0
+        }
+    })
+    plain = lighthouse.Node.from_dict({
+        "name": "node",
+        "resources": {
+            "cpu": 2.5,
+            "mem": 8.0
+        }
+    })
+    assert repr(n) == repr(plain)
+    assert str(n) == str(plain)
+    assert n == CompactNode.from_dict({
+        "name": "node",
+        "resources": {
+            "mem": 8,
+            "cpu": 2.5
+        }
+    })
+    assert n != plain
+
+    # Integers stay integers, as they would in a plain node
+    ints = CompactNode("node", {"cpu": 4, "mem": 8.0})
+    assert repr(ints) == repr(lighthouse.Node("node", {"cpu": 4, "mem": 8.0}))
+    assert isinstance(ints.resources["cpu"], int)
+    assert ints.attempt_attach(CompactWorkload("one", {"cpu": 1}))
+    assert repr(ints.resources) == "{'cpu': 3, 'mem': 8.0}"
+    ints.resources["cpu"] = 2.5
+    assert ints.resources["cpu"] == 2.5
+
+    w = CompactWorkload.from_dict({
+        "name": "load",
+        "requirements": {
+            "cpu": 0.5
+        },
+        "immunities": ["spiders"],
+        "aversion_groups": ["rivals"]
+    })
+    assert w.immunities == set(["spiders"])
+    assert w.aversion_groups == set(["rivals"])
+    assert repr(w) == repr(lighthouse.Workload.from_dict({
+        "name": "load",
+        "requirements": {
+            "cpu": 0.5
+        },
+        "immunities": ["spiders"],
+        "aversion_groups": ["rivals"]
+    }))
+
+
+def test_compact_placement():
+    nodes = CompactNode.from_list([
+        {
+            "name": "house-1",
+            "resources": {
+                "bathroom": 25,
+                "bedroom": 10,
+                "kitchen": 10
+            }
+        },
+        {
+            "name": "house-2",
+            "resources": {
+                "bathroom": 25,
+                "bedroom": 10,
+                "kitchen": 15,
+                "spiders": -float("inf")
+            }
+        }
+    ])
+    loads = CompactWorkload.from_list([
+        {
+            "name": "student-1",
+            "requirements": {
+                "bathroom": 5,
+                "bedroom": 2
+            },
+            "aversion_groups": ["rivalry"]
+        },
+        {
+            "name": "student-2",
+            "requirements": {
+                "bathroom": 5,
+                "bedroom": 2
+            },
+            "immunities": ["spiders"],
+            "aversion_groups": ["rivalry"]
+        }
+    ])
+    distor = lighthouse.BinPackDistributor.from_list(
+        {"bathroom": 1, "bedroom": 1}, nodes)
+    assert distor.attempt_assign_loads(loads) == {
+        "student-1": "house-1",
+        "student-2": "house-2"
+    }
+    assert nodes[0].resources == {"bathroom": 20, "bedroom": 8,
+                                  "kitchen": 10}
+    assert not hasattr(nodes[0], "__dict__")
+    assert not hasattr(loads[0], "__dict__")
+    for n in nodes:
+        n.detach_all()
+    assert nodes[1].resources["bathroom"] == 25
+
+def test_compact_workload_plan():
+    node = CompactNode("node", {"cpu": 4})
+    load = CompactWorkload("load", {"cpu": 2})
+    assert node._fit(load) == {"cpu": 2}
+    assert not hasattr(load, "__dict__")
+    load.requirements["cpu"] = 5
+    assert node._fit(load) is None
+    load.requirements = ResourceVector({"cpu": 1})
+    assert node._fit(load) == {"cpu": 3}
+    load.requirements["cpu"] = 6
+    assert node._fit(load) is None
+
+
+def test_compact_copy_and_pickle():
+    nodes = [CompactNode("node-%d" % i, {"cpu": 4, "gpu": 1})
+             for i in range(2)]
+    distor = lighthouse.PrioritizedDistributor(nodes)
+    for copied in (copy.deepcopy(nodes), pickle.loads(pickle.dumps(nodes))):
+        assert copied == nodes
+        assert copied[0].resources.schema is lighthouse.DEFAULT_SCHEMA
+        assert not hasattr(copied[0], "__dict__")
+        assert copied[0].attempt_attach(CompactWorkload("x", {"cpu": 3}))
+        assert distor.placements == {}
+        assert nodes[0].resources == {"cpu": 4, "gpu": 1}
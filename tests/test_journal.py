@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+'''
+Tests for `pylighthouse.journal`.
+'''
+
+import pytest
+
+import pylighthouse.pylighthouse as lighthouse
+from pylighthouse import journal
+from pylighthouse.compact import CompactNode, CompactWorkload
+
+from test_snapshot import cluster, state, workloads
+
+
+def churn(distor, make_node, make_load):
+    '''
+    Places, releases, updates, adds and removes, and rolls a transaction
+    back.
+    '''
+    distor.attempt_assign_loads(workloads(make_load, 12, 8))
+    distor.release(["load-1", "load-13", "load-absent"])
+    distor.update_resources("node-2", {"mem": 3.5, "gpu": 2})
+    distor.get_node("node-3").add_ward("tests")
+    distor.add_node(make_node("node-9", {"cpu": 4, "mem": 1.0}))
+    distor.attempt_assign_loads(workloads(make_load, 20, 4))
+    with distor.transaction() as t:
+        distor.attempt_assign_loads(workloads(make_load, 24, 4))
+        distor.release(["load-2"])
+        distor.update_resources("node-0", {"cpu": 1})
+        t.rollback()
+    distor.remove_node("node-0", drain=True)
+
+
+@pytest.mark.parametrize("make", [
+    lighthouse.PrioritizedDistributor,
+    lighthouse.RoundRobinDistributor,
+    lambda ns: lighthouse.RoundRobinDistributor(ns).use_headroom_index(),
+    lambda ns: lighthouse.BinPackDistributor.from_list(
+        {"cpu": 1, "mem": 0.1}, ns),
+    lambda ns: lighthouse.VectorBinPackDistributor.from_list(
+        {"cpu": 1, "mem": 0.1}, ns),
+    lambda ns: lighthouse.LeastLoadedDistributor.from_list(ns, ["cpu"])
+])
+@pytest.mark.parametrize("kinds", [
+    (lighthouse.Node, lighthouse.Workload),
+    (CompactNode, CompactWorkload)
+])
+def test_journal_recover(tmpdir, make, kinds):
+    make_node, make_load = kinds
+    snap = str(tmpdir.join("cluster.snapshot"))
+    log = str(tmpdir.join("cluster.journal"))
+    distor = make(cluster(make_node)).use_journal(log, batch=4)
+    distor.attempt_assign_loads(workloads(make_load, 0, 12))
+    distor.snapshot(snap)
+    churn(distor, make_node, make_load)
+    distor.journal.sync()
+
+    recovered = journal.recover(snap, log)
+    assert state(recovered) == state(distor)
+    assert isinstance(recovered.get_node("node-9"), make_node)
+
+    # Journaling picks up where the recovered journal left off
+    recovered.use_journal(log)
+    distor.release(["load-3", "load-20"])
+    recovered.release(["load-3", "load-20"])
+    assert recovered.attempt_assign_loads(workloads(make_load, 40, 6)) == \
+        distor.attempt_assign_loads(workloads(make_load, 40, 6))
+    recovered.journal.close()
+    assert state(journal.recover(snap, log)) == state(distor)
+
+
+def test_journal_recover_wards(tmpdir):
+    '''
+    Replaying placements restored by a rollback restores the wards they
+    cross
+    '''
+    snap = str(tmpdir.join("cluster.snapshot"))
+    log = str(tmpdir.join("cluster.journal"))
+    distor = lighthouse.PrioritizedDistributor(
+        [lighthouse.Node("node", {"cpu": 4, "mem": 5, "gpu": 3})])
+    distor.snapshot(snap)
+    distor.use_journal(log)
+    distor.attempt_assign_loads([
+        lighthouse.Workload("a", {"mem": 2, "gpu": 2}),
+        lighthouse.Workload("b", {"cpu": 2, "mem": 5}, set(["mem"]))
+    ])
+    with distor.transaction() as tx:
+        distor.release(["a", "b"])
+        tx.rollback()
+    distor.journal.close()
+
+    recovered = journal.recover(snap, log)
+    node = recovered.get_node("node")
+    assert node.resources == {"cpu": 2, "mem": -2, "gpu": 1}
+    assert node._wards == distor.get_node("node")._wards
+    assert recovered.attempt_assign_loads([
+        lighthouse.Workload("c", {"cpu": 1})
+    ]) == {"c": None}
+
+
+def test_journal_torn_and_stale(tmpdir):
+    snap = str(tmpdir.join("cluster.snapshot"))
+    log = tmpdir.join("cluster.journal")
+    distor = lighthouse.RoundRobinDistributor(cluster(lighthouse.Node))
+    distor.use_journal(str(log))
+    distor.snapshot(snap)
+    distor.attempt_assign_loads(workloads(lighthouse.Workload, 0, 3))
+    distor.journal.sync()
+    expected = state(distor)
+
+    # A record cut short by a crash is ignored, as are unsynced ones
+    distor.attempt_assign_loads(workloads(lighthouse.Workload, 3, 1))
+    data = log.read_binary()
+    log.write_binary(data + b"\x40\x00\x00\x00\x00\x00")
+    assert state(journal.recover(snap, str(log))) == expected
+
+    # A journal kept before the latest snapshot is not replayed over it
+    log.write_binary(data)
+    distor.journal = None
+    distor.snapshot(snap)
+    assert journal.recover(snap, str(log)).placements.keys() == \
+        distor.placements.keys()
+    assert journal.replay(lighthouse.Distributor.restore(snap),
+                          str(log)) == 0
+
+    log.write_binary(b"not a journal")
+    with pytest.raises(lighthouse.LighthouseException):
+        journal.recover(snap, str(log))
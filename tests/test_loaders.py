@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+'''
+Tests for `pylighthouse.loaders`.
+'''
+
+import json
+
+import pytest
+
+from pylighthouse.compact import CompactNode, CompactWorkload
+from pylighthouse import loaders
+
+NODES = [
+    {
+        "name": "node-1",
+        "resources": {
+            "cpu": 8,
+            "mem": 16
+        }
+    },
+    {
+        "name": "node-2",
+        "resources": {
+            "cpu": 4,
+            "spiders": -float("inf")
+        },
+        "assigned_workloads": [
+            {
+                "name": "resident",
+                "requirements": {
+                    "cpu": 1
+                },
+                "immunities": ["spiders"],
+                "aversion_groups": ["web"]
+            }
+        ]
+    }
+]
+
+WORKLOADS = [
+    {
+        "name": "load-1",
+        "requirements": {
+            "cpu": 2,
+            "mem": 1.5
+        },
+        "immunities": ["spiders"],
+        "aversion_groups": ["web"]
+    },
+    {
+        "name": "load-2",
+        "requirements": {
+            "cpu": 1
+        }
+    }
+]
+
+
+def expected_nodes():
+    nodes = CompactNode.from_list([
+        dict(NODES[0]),
+        dict(NODES[1], assigned_workloads=None)])
+    nodes[1].attempt_attach(CompactWorkload.from_dict(
+        NODES[1]["assigned_workloads"][0]))
+    nodes[1].resources["cpu"] = 4
+    return nodes
+
+
+def test_jsonl(tmpdir):
+    path = tmpdir.join("nodes.jsonl")
+    path.write("\n".join(json.dumps(n) for n in NODES) + "\n\n")
+    nodes = list(loaders.nodes_from_jsonl(str(path)))
+    assert nodes == expected_nodes()
+    assert nodes[1]._aversions == {"web": 1}
+    assert nodes[1]._fit(CompactWorkload.from_dict(WORKLOADS[1])) is None
+
+    path = tmpdir.join("workloads.jsonl")
+    path.write("\n".join(json.dumps(w) for w in WORKLOADS))
+    with open(str(path)) as f:
+        loads = list(loaders.workloads_from_jsonl(f))
+    assert loads == CompactWorkload.from_list(WORKLOADS)
+    assert all(isinstance(w, CompactWorkload) for w in loads)
+
+
+def test_msgpack(tmpdir):
+    msgpack = pytest.importorskip("msgpack")
+    path = tmpdir.join("cluster.msgpack")
+    with open(str(path), "wb") as f:
+        for n in NODES:
+            f.write(msgpack.packb(n))
+    assert list(loaders.nodes_from_msgpack(str(path))) == expected_nodes()
+    path = tmpdir.join("workloads.msgpack")
+    with open(str(path), "wb") as f:
+        for w in WORKLOADS:
+            f.write(msgpack.packb(w))
+    assert list(loaders.workloads_from_msgpack(str(path))) == \
+        CompactWorkload.from_list(WORKLOADS)
+
+
+def test_arrow(tmpdir):
+    pyarrow = pytest.importorskip("pyarrow")
+    parquet = pytest.importorskip("pyarrow.parquet")
+    table = pyarrow.Table.from_pylist([
+        {
+            "name": w["name"],
+            "requirements": w["requirements"],
+            "immunities": w.get("immunities"),
+            "aversion_groups": w.get("aversion_groups")
+        } for w in WORKLOADS])
+    assert pyarrow.types.is_struct(table.schema.field("requirements").type)
+    assert list(loaders.workloads_from_arrow(table)) == \
+        CompactWorkload.from_list(WORKLOADS)
+
+    path = str(tmpdir.join("workloads.parquet"))
+    parquet.write_table(table, path)
+    assert list(loaders.workloads_from_parquet(path, batch_size=1)) == \
+        CompactWorkload.from_list(WORKLOADS)
+
+    mapped = pyarrow.table({
+        "name": [n["name"] for n in NODES],
+        "resources": pyarrow.array(
+            [list(n["resources"].items()) for n in NODES],
+            type=pyarrow.map_(pyarrow.string(), pyarrow.float64()))
+    })
+    nodes = list(loaders.nodes_from_arrow(mapped.to_batches()))
+    assert nodes == CompactNode.from_list(
+        [dict(n, assigned_workloads=None) for n in NODES])
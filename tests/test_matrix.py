@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+'''
+Tests for `pylighthouse.matrix`.
+'''
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+import pylighthouse.pylighthouse as lighthouse
+from pylighthouse.matrix import ResourceMatrix
+
+
+@pytest.fixture
+def nodes():
+    return lighthouse.Node.from_list([
+        {
+            "name": "small",
+            "resources": {
+                "cpu": 2,
+                "mem": 2
+            }
+        },
+        {
+            "name": "tagged",
+            "resources": {
+                "cpu": 8,
+                "mem": 8,
+                "gpu": 0
+            }
+        },
+        {
+            "name": "warded",
+            "resources": {
+                "cpu": 8,
+                "mem": 8,
+                "spiders": -float("inf")
+            }
+        }
+    ])
+
+
+def test_feasible_mask(nodes):
+    matrix = ResourceMatrix(nodes)
+    plain = lighthouse.Workload.from_dict({
+        "name": "plain",
+        "requirements": {
+            "cpu": 4
+        }
+    })
+    assert list(matrix.feasible(plain)) == [False, True, False]
+
+    immune = lighthouse.Workload.from_dict({
+        "name": "immune",
+        "requirements": {
+            "cpu": 4
+        },
+        "immunities": ["spiders"]
+    })
+    assert list(matrix.feasible(immune)) == [False, True, True]
+
+    tagged = lighthouse.Workload.from_dict({
+        "name": "tagged",
+        "requirements": {
+            "gpu": 0
+        }
+    })
+    assert list(matrix.feasible(tagged)) == [False, True, False]
+
+    unknown = lighthouse.Workload.from_dict({
+        "name": "unknown",
+        "requirements": {
+            "disk": 1
+        }
+    })
+    assert list(matrix.feasible(unknown)) == [False, False, False]
+
+
+def test_mask_agrees_with_attach(nodes):
+    matrix = ResourceMatrix(nodes)
+    loads = lighthouse.Workload.from_list([
+        {"name": "a", "requirements": {"cpu": 1, "mem": 3}},
+        {"name": "b", "requirements": {"cpu": 9}},
+        {"name": "c", "requirements": {"mem": -4}},
+        {"name": "d", "requirements": {}, "immunities": ["spiders"]},
+        {"name": "e", "requirements": {"cpu": 10}, "immunities": ["cpu"]},
+    ])
+    for load in loads:
+        mask = matrix.feasible(load)
+        for i, n in enumerate(nodes):
+            start = lighthouse.Node.from_dict(dict(n.__dict__,
+                resources=dict(n.resources)))
+            assert bool(mask[i]) == start.attempt_attach(load)
+
+
+def test_update_follows_node(nodes):
+    matrix = ResourceMatrix(nodes)
+    load = lighthouse.Workload.from_dict({
+        "name": "big",
+        "requirements": {
+            "cpu": 6
+        }
+    })
+    assert nodes[1].attempt_attach(load)
+    matrix.update(nodes[1])
+    assert not matrix.feasible(load)[1]
+
+    nodes[0].add_ward("rats")
+    matrix.update(nodes[0])
+    assert "rats" in matrix.columns
+    tiny = lighthouse.Workload.from_dict({
+        "name": "tiny",
+        "requirements": {
+            "cpu": 1
+        }
+    })
+    assert list(matrix.feasible(tiny)) == [False, True, False]
+
+
+def test_distributors_use_matrix(nodes):
+    loads = lighthouse.Workload.from_list([
+        {"name": "a", "requirements": {"cpu": 4, "mem": 4}},
+        {"name": "b", "requirements": {"cpu": 4, "mem": 4}},
+        {"name": "c", "requirements": {"cpu": 4, "mem": 4},
+         "immunities": ["spiders"]},
+        {"name": "d", "requirements": {"cpu": 4}},
+    ])
+    expected = {
+        "a": "tagged",
+        "b": "tagged",
+        "c": "warded",
+        "d": None
+    }
+    distors = [
+        lambda ns: lighthouse.PrioritizedDistributor.from_list(ns),
+        lambda ns: lighthouse.RoundRobinDistributor.from_list(ns),
+        lambda ns: lighthouse.BinPackDistributor.from_list(
+            {"cpu": 1, "mem": 1}, ns),
+    ]
+    for make in distors:
+        for n in nodes:
+            n.detach_all()
+        plain = make(nodes).attempt_assign_loads(loads)
+        for n in nodes:
+            n.detach_all()
+        screened = make(nodes).use_matrix().attempt_assign_loads(loads)
+        assert screened == plain
+    assert plain == expected
+
+
+def test_batch_shares_masks(nodes):
+    matrix = ResourceMatrix(nodes)
+    loads = lighthouse.Workload.from_list([
+        {"name": "a", "requirements": {"cpu": 3}},
+        {"name": "b", "requirements": {"cpu": 3}},
+        {"name": "c", "requirements": {"mem": 1}},
+    ])
+    matrix.begin(loads)
+    assert matrix.batch.pending == [2, 1]
+    first = matrix.screen(loads[0])
+    assert [first(n) for n in nodes] == [False, True, False]
+    assert nodes[1].attempt_attach(loads[0])
+    matrix.update(nodes[1])
+    second = matrix.screen(loads[1])
+    assert [second(n) for n in nodes] == [False, True, False]
+    assert matrix.batch.masks == {}
+    assert nodes[1].attempt_attach(loads[1])
+    matrix.update(nodes[1])
+    third = matrix.screen(loads[2])
+    assert [third(n) for n in nodes] == [True, True, False]
+    matrix.end()
+    assert matrix.batch is None
+
+
+def test_batch_matches_sequential():
+    def cluster():
+        return lighthouse.Node.from_list([
+            {"name": "n-%d" % i,
+             "resources": {"cpu": 4 + i % 3, "mem": 8 - i % 4}}
+            for i in range(12)])
+    loads = lighthouse.Workload.from_list([
+        {"name": "w-%d" % i,
+         "requirements": {"cpu": 1 + i % 2, "mem": 1 + i % 3},
+         "aversion_groups": ["g-%d" % (i % 5)]}
+        for i in range(60)])
+    makers = [
+        lambda ns: lighthouse.PrioritizedDistributor.from_list(ns),
+        lambda ns: lighthouse.RoundRobinDistributor.from_list(ns),
+        lambda ns: lighthouse.BinPackDistributor.from_list(
+            {"cpu": 1, "mem": 0.5}, ns),
+    ]
+    for make in makers:
+        plain = make(cluster()).attempt_assign_loads(loads)
+        batched = make(cluster()).use_matrix().attempt_assign_loads(
+            iter(loads))
+        assert batched == plain
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_parallel_matches_sequential(processes):
+    def cluster():
+        nodes = lighthouse.Node.from_list([
+            {"name": "n-%03d" % i,
+             "resources": {"cpu": 2 + i % 7, "mem": 3 + i % 5}}
+            for i in range(50)])
+        for n in nodes[::9]:
+            n.add_ward("dedicated")
+        return nodes
+    loads = lighthouse.Workload.from_list([
+        {"name": "w-%d" % i,
+         "requirements": {"cpu": 1 + i % 4, "mem": 1 + i % 3},
+         "immunities": ["dedicated"] if i % 5 == 0 else []}
+        for i in range(120)])
+    makers = [
+        lambda ns: lighthouse.PrioritizedDistributor.from_list(ns),
+        lambda ns: lighthouse.RoundRobinDistributor.from_list(ns),
+        lambda ns: lighthouse.BinPackDistributor.from_list(
+            {"cpu": 1, "mem": 1}, ns),
+    ]
+    for make in makers:
+        expected = make(cluster()).attempt_assign_loads(loads)
+        nodes = cluster()
+        parallel = make(nodes).use_matrix(workers=3, processes=processes,
+                                          shard_rows=8)
+        try:
+            assert parallel.attempt_assign_loads(loads) == expected
+            nodes[0].resources["gpu"] = 1
+            parallel.matrix.update(nodes[0])
+            gpu = lighthouse.Workload.from_dict({
+                "name": "gpu",
+                "requirements": {"gpu": 1},
+                "immunities": ["dedicated"]
+            })
+            assert list(numpy.flatnonzero(
+                parallel.matrix.feasible(gpu))) == [
+                    parallel.matrix.rows[nodes[0].name]]
+        finally:
+            parallel.matrix.close()
+
+
+def test_membership_rows(nodes):
+    distor = lighthouse.PrioritizedDistributor.from_list(
+        list(nodes)).use_matrix()
+    matrix = distor.matrix
+    extra = lighthouse.Node("extra", {"cpu": 16, "disk": 4})
+    distor.add_node(extra)
+    assert matrix.size == 4
+    assert matrix.values.shape[0] >= 4
+    disk = lighthouse.Workload.from_dict({
+        "name": "disk",
+        "requirements": {
+            "disk": 1
+        }
+    })
+    assert list(matrix.feasible(disk)) == [False, False, False, True]
+    distor.remove_node("small")
+    assert matrix.size == 3
+    assert matrix.order == ["extra", "tagged", "warded"]
+    assert matrix.rows == {"extra": 0, "tagged": 1, "warded": 2}
+    assert list(matrix.feasible(disk)) == [True, False, False]
+    big = lighthouse.Workload.from_dict({
+        "name": "big",
+        "requirements": {
+            "cpu": 12
+        }
+    })
+    assert distor.attempt_assign_loads([big, disk]) == {
+        "big": "extra",
+        "disk": "extra"
+    }
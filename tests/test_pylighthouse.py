@@ -18,6 +18,13 @@
 Tests for `pylighthouse` package.
 '''
 
+import copy
+import pickle
+import random
+import sys
+import threading
+from collections import OrderedDict
+
 import pytest
 
 import pylighthouse.pylighthouse as lighthouse
@@ -331,6 +338,43 @@ def placestrat():
     ])
     return {"nodes": nodes, "workloads": workloads}
 
+class VisitedNode(lighthouse.Node):
+    '''
+    A node which notes its name in ``VisitedNode.visited`` each time its
+    capacity for a load is evaluated.
+    '''
+    visited = []
+
+    def _fit(self, load, plan=None):
+        VisitedNode.visited.append(self.name)
+        return super(VisitedNode, self)._fit(load, plan)
+
+@pytest.fixture
+def visited():
+    del VisitedNode.visited[:]
+    return VisitedNode.visited
+
+DISTRIBUTORS = [
+    lighthouse.PrioritizedDistributor,
+    lighthouse.RoundRobinDistributor,
+    lighthouse.BinPackDistributor,
+    lighthouse.VectorBinPackDistributor
+]
+
+def distributors(cluster, rubric, kinds=DISTRIBUTORS, capacity_index=False):
+    '''
+    Yields a distributor of each of the given kinds over a fresh
+    ``cluster()``, the bin-packing ones scoring nodes by ``rubric``.
+    '''
+    for kind in kinds:
+        if issubclass(kind, lighthouse.BinPackDistributor):
+            distor = kind.from_list(rubric, cluster())
+            if capacity_index:
+                distor.use_capacity_index()
+        else:
+            distor = kind.from_list(cluster())
+        yield distor
+
 def test_doc_placestrat_prioritized(placestrat):
     '''
     Test documentation examples for placment strategies: Prioritized
@@ -639,3 +683,1063 @@ def test_aversion_group():
         "college-student-1": "house-1",
         "college-student-2": "house-1"
         })
+
+def test_aversion_index():
+    '''
+    Nodes count workloads per aversion group, and distributors keep a
+    cluster-wide index of which nodes host which groups
+    '''
+    nodes = lighthouse.Node.from_list([
+        {
+            "name": "house-1",
+            "resources": {
+                "bedroom": 10
+            }
+        },
+        {
+            "name": "house-2",
+            "resources": {
+                "bedroom": 10
+            }
+        }
+    ])
+    workloads = lighthouse.Workload.from_list([
+        {
+            "name": "north-%d" % i,
+            "requirements": {
+                "bedroom": 1
+            },
+            "aversion_groups": ["north", "students"]
+        } for i in range(3)
+    ] + [
+        {
+            "name": "south",
+            "requirements": {
+                "bedroom": 1
+            },
+            "aversion_groups": ["south"]
+        }
+    ])
+    pr = lighthouse.PrioritizedDistributor.from_list(nodes)
+    assert pr.attempt_assign_loads(workloads) == {
+        "north-0": "house-1",
+        "north-1": "house-2",
+        "north-2": "house-1",
+        "south": "house-1"
+    }
+    assert nodes[0]._aversions == {"north": 2, "students": 2, "south": 1}
+    assert pr.aversions.groups == {
+        "north": set(["house-1", "house-2"]),
+        "students": set(["house-1", "house-2"]),
+        "south": set(["house-1"])
+    }
+    assert pr.aversions.averse_nodes(workloads[3]) == set(["house-1"])
+
+    nodes[0].detach_all()
+    assert nodes[0]._aversions == {}
+    assert pr.aversions.groups == {
+        "north": set(["house-2"]),
+        "students": set(["house-2"])
+    }
+    assert not nodes[0].has_averse_loads(workloads[0])
+    assert nodes[1].has_averse_loads(workloads[0])
+
+def two_pass_assign(distor, loads):
+    '''
+    Reference placement: an amicable pass over every candidate, then a
+    second pass which ignores aversion groups.
+    '''
+    results = {}
+    for l in distor._arrange(loads):
+        results[l.name] = None
+        for placer in [lambda n: n.attempt_attach_amicable(l),
+                       lambda n: n.attempt_attach(l)]:
+            found = None
+            for n in distor._candidates(l):
+                if placer(n):
+                    found = n
+                    break
+            if found is not None:
+                distor._placed(found, l)
+                results[l.name] = found.name
+                break
+    return results
+
+def test_single_pass_matches_two_pass():
+    def cluster():
+        return lighthouse.Node.from_list([
+            {
+                "name": "node-%d" % i,
+                "resources": {
+                    "cpu": 3 + (i * 7) % 5,
+                    "mem": 4 + (i * 3) % 4
+                }
+            } for i in range(8)])
+    loads = lighthouse.Workload.from_list([
+        {
+            "name": "load-%d" % i,
+            "requirements": {
+                "cpu": 1 + i % 3,
+                "mem": 1 + (i * 5) % 2
+            },
+            "aversion_groups": ["group-%d" % (i % 4)]
+        } for i in range(40)])
+    kinds = DISTRIBUTORS[:3]
+    rubric = {"cpu": 1, "mem": 0.5}
+    for single, double in zip(distributors(cluster, rubric, kinds),
+                              distributors(cluster, rubric, kinds)):
+        assert single.attempt_assign_loads(loads) == \
+            two_pass_assign(double, loads)
+        assert list(single._all_nodes()) == list(double._all_nodes())
+
+def test_single_pass_fits_once(visited):
+    '''
+    Each node's capacity is evaluated at most once per load, even when the
+    load can only be placed next to an averse load
+    '''
+    nodes = [VisitedNode("node-%d" % i, {"cpu": 1 - i % 2})
+             for i in range(4)]
+    loads = lighthouse.Workload.from_list([
+        {
+            "name": "first",
+            "requirements": {"cpu": 1},
+            "aversion_groups": ["rivals"]
+        },
+        {
+            "name": "second",
+            "requirements": {"cpu": 0},
+            "aversion_groups": ["rivals"]
+        },
+        {
+            "name": "third",
+            "requirements": {"cpu": 1},
+            "aversion_groups": ["rivals"]
+        }])
+    pr = lighthouse.PrioritizedDistributor.from_list(nodes)
+    assert pr.attempt_assign_loads(loads) == {
+        "first": "node-0",
+        "second": "node-1",
+        "third": "node-2"
+    }
+    assert visited == ["node-0",
+                    "node-0", "node-1",
+                    "node-0", "node-1", "node-2"]
+
+def test_binpack_range_search(visited):
+    '''
+    BinPack only visits nodes scoring at least as much as the load
+    '''
+    nodes = [VisitedNode("node-%d" % i, {"cpu": i, "gpu": i % 2})
+             for i in range(10)]
+    bp = lighthouse.BinPackDistributor.from_list({"cpu": 1}, nodes)
+    load = lighthouse.Workload.from_dict({
+        "name": "big",
+        "requirements": {
+            "cpu": 7,
+            "gpu": 1
+        }
+    })
+    assert bp.attempt_assign_loads([load]) == {"big": "node-7"}
+    assert visited == ["node-7"]
+    assert bp.scores["node-7"] == 0
+
+def test_binpack_capacity_index(visited):
+    '''
+    The capacity index prunes nodes short on the load's scarcest resource
+    without changing where loads land
+    '''
+    def cluster():
+        return [VisitedNode("node-%d" % i,
+                            {"cpu": 10 + i, "gpu": 1 if i in (3, 8) else 0})
+                for i in range(10)]
+    loads = lighthouse.Workload.from_list([
+        {
+            "name": "gpu-%d" % i,
+            "requirements": {
+                "cpu": 2,
+                "gpu": 1
+            }
+        } for i in range(3)] + [
+        {
+            "name": "cpu-%d" % i,
+            "requirements": {
+                "cpu": 1
+            }
+        } for i in range(3)])
+    rubric = {"cpu": 1}
+    plain = lighthouse.BinPackDistributor.from_list(rubric, cluster())
+    expected = plain.attempt_assign_loads(loads)
+    assert expected["gpu-0"] == "node-3"
+    assert expected["gpu-2"] is None
+    del visited[:]
+    nodes = cluster()
+    indexed = lighthouse.BinPackDistributor.from_list(
+        rubric, nodes).use_capacity_index()
+    assert indexed.attempt_assign_loads(loads) == expected
+    assert visited[:3] == ["node-3", "node-8", "node-0"]
+    assert list(indexed.capacities.fitting("gpu", 1)) == []
+    nodes[3].detach_all()
+    assert list(indexed.capacities.fitting("gpu", 1)) == ["node-3"]
+
+def test_vector_binpack(visited):
+    '''
+    VectorBinPack agrees with BinPack, but skips nodes that are short on
+    any one resource
+    '''
+    def cluster():
+        return [VisitedNode("ram-%d" % i, {"ram": 512, "cpu": 8, "gpu": 0})
+                for i in range(6)] + \
+            [VisitedNode("gpu-%d" % i, {"ram": 64, "cpu": 8, "gpu": 2})
+             for i in range(2)]
+    loads = lighthouse.Workload.from_list([
+        {
+            "name": "train-%d" % i,
+            "requirements": {
+                "ram": 32,
+                "cpu": 2,
+                "gpu": 1
+            }
+        } for i in range(5)] + [
+        {
+            "name": "tagged",
+            "requirements": {
+                "gpu": 0
+            }
+        }])
+    rubric = {"ram": 1, "cpu": 1, "gpu": 1}
+    expected = lighthouse.BinPackDistributor.from_list(
+        rubric, cluster()).attempt_assign_loads(loads)
+    assert expected["train-3"] == "gpu-1"
+    assert expected["train-4"] is None
+    del visited[:]
+    vbp = lighthouse.VectorBinPackDistributor.from_list(rubric, cluster())
+    assert vbp.attempt_assign_loads(loads) == expected
+    assert [v for v in visited[:4] if v.startswith("ram")] == []
+
+def test_rubric_score():
+    rubric = lighthouse.Rubric({"cpu": 1, "mem": 0.5, "disk": 0.25})
+    assert rubric.score({}) == 0
+    assert rubric.score({"cpu": 2}) == 2
+    assert rubric.score({"cpu": 2, "mem": 4, "disk": 8, "gpu": 1,
+                         "tag": 0}) == 6
+    assert rubric.deduct(6, 2) == 4
+    assert rubric.deduct(-float("inf"), 2) is None
+    assert rubric.deduct(6, float("inf")) is None
+
+def test_binpack_delta_scores():
+    '''
+    BinPack keeps node scores current without rescoring from scratch,
+    except where infinities are involved
+    '''
+    nodes = lighthouse.Node.from_list([
+        {
+            "name": "node-%d" % i,
+            "resources": {
+                "cpu": 16 + i,
+                "mem": 32,
+                "spiders": 0
+            }
+        } for i in range(4)])
+    nodes[3].add_ward("spiders")
+    loads = lighthouse.Workload.from_list([
+        {
+            "name": "load-%d" % i,
+            "requirements": {
+                "cpu": 1 + i % 3,
+                "mem": 2
+            },
+            "immunities": ["spiders"]
+        } for i in range(30)])
+    rubric = lighthouse.Rubric({"cpu": 1, "mem": 0.5, "spiders": 1})
+    bp = lighthouse.BinPackDistributor(rubric, nodes)
+    bp.attempt_assign_loads(loads)
+    for n in nodes:
+        assert bp.scores[n.name] == rubric.score(n.resources)
+        assert bp.nodes[(bp.scores[n.name], n.name)] is n
+    assert bp.scores["node-3"] == -float("inf")
+    nodes[0].detach_all()
+    assert bp.scores["node-0"] == 32
+
+
+def test_binpack_float_exact_fit():
+    '''
+    Float scores are recomputed rather than deducted, so they never drift
+    and a load which exactly fits what a node has left is placed there
+    '''
+    node = lighthouse.Node("n", {"cpu": 4.2, "mem": 4.8})
+    bp = lighthouse.BinPackDistributor.from_list({"cpu": 0.7, "mem": 0.8},
+                                                 [node])
+    assert bp.attempt_assign_loads([
+        lighthouse.Workload("first", {"cpu": 0.8, "mem": 0.7})]) == \
+        {"first": "n"}
+    assert bp.scores["n"] == bp.rubric.score(node.resources)
+    assert bp.attempt_assign_loads([
+        lighthouse.Workload("rest", dict(node.resources))]) == {"rest": "n"}
+
+    rng = random.Random(3)
+    nodes = [lighthouse.Node("node-%d" % i, {
+        "cpu": round(rng.uniform(1, 8), 1),
+        "mem": round(rng.uniform(1, 8), 1)}) for i in range(5)]
+    bp = lighthouse.BinPackDistributor.from_list({"cpu": 0.7, "mem": 0.3},
+                                                 nodes)
+    for i in range(200):
+        bp.attempt_assign_loads([lighthouse.Workload("load-%d" % i, {
+            "cpu": round(rng.uniform(0.1, 2), 1),
+            "mem": round(rng.uniform(0.1, 2), 1)})])
+        if i % 4 == 0:
+            bp.release(["load-%d" % rng.randint(0, i)])
+        for n in nodes:
+            assert bp.scores[n.name] == bp.rubric.score(n.resources)
+
+def test_detach_one():
+    n = lighthouse.Node.from_dict({
+        "name": "house",
+        "resources": {
+            "bedroom": 3,
+            "kitchen": 1
+        }
+    })
+    loads = lighthouse.Workload.from_list([
+        {
+            "name": "tenant-%d" % i,
+            "requirements": {
+                "bedroom": 1,
+                "kitchen": 0
+            },
+            "aversion_groups": ["rivals"]
+        } for i in range(3)])
+    start = lighthouse.Node.from_dict({
+        "name": "house",
+        "resources": dict(n.resources)
+    })
+    for l in loads:
+        assert n.attempt_attach(l)
+    assert n.detach("tenant-1") == loads[1]
+    assert n.detach("tenant-1") is None
+    assert n.resources == {"bedroom": 1, "kitchen": 1}
+    assert sorted(n.assigned_workloads.keys()) == ["tenant-0", "tenant-2"]
+    assert n._aversions == {"rivals": 2}
+    n.detach("tenant-0")
+    n.detach("tenant-2")
+    assert n == start
+    assert n._aversions == {}
+
+def test_release():
+    '''
+    Releasing single workloads frees their resources and keeps the
+    distributor's indexes current
+    '''
+    def cluster():
+        return lighthouse.Node.from_list([
+            {
+                "name": "house-%d" % i,
+                "resources": {
+                    "bedroom": 2 + i
+                }
+            } for i in range(3)])
+    loads = lighthouse.Workload.from_list([
+        {
+            "name": "tenant-%d" % i,
+            "requirements": {
+                "bedroom": 1
+            },
+            "aversion_groups": ["rivals"]
+        } for i in range(9)])
+    for distor in distributors(cluster, {"bedroom": 1}):
+        placed = distor.attempt_assign_loads(loads)
+        assert distor.attempt_assign_loads(loads[:1]) == {"tenant-0": None}
+        released = distor.release(["tenant-4", "tenant-7", "nobody"])
+        assert released == {
+            "tenant-4": placed["tenant-4"],
+            "tenant-7": placed["tenant-7"],
+            "nobody": None
+        }
+        for n in distor._all_nodes():
+            if isinstance(distor, lighthouse.BinPackDistributor):
+                assert distor.scores[n.name] == n.resources["bedroom"]
+                assert distor.nodes[(n.resources["bedroom"], n.name)] is n
+            assert ("rivals" in distor.aversions.groups and
+                    n.name in distor.aversions.groups["rivals"]) == \
+                bool(n.assigned_workloads)
+        again = distor.attempt_assign_loads(loads[4:5])
+        assert again["tenant-4"] is not None
+
+def test_name_lookups(placestrat):
+    rubric_dict = {
+        "cpu": 1,
+        "mem": 0.5,
+        "disk": 0.025
+    }
+    distor = lighthouse.BinPackDistributor.from_list(rubric_dict,
+                                                     placestrat['nodes'])
+    assert distor.get_node("node-2") is placestrat['nodes'][1]
+    assert distor.get_node("node-4") is None
+    distor.attempt_assign_loads(placestrat['workloads'])
+    assert distor.locate("req-2") is placestrat['nodes'][2]
+    assert distor.locate("req-4") is None
+    distor.release(["req-2"])
+    assert distor.locate("req-2") is None
+    placestrat['nodes'][2].detach_all()
+    assert distor.placements == {}
+
+    busy = lighthouse.Node.from_dict({
+        "name": "busy",
+        "resources": {},
+        "assigned_workloads": {
+            "already-here": lighthouse.Workload("already-here", {})
+        }
+    })
+    pr = lighthouse.PrioritizedDistributor.from_list([busy])
+    assert pr.locate("already-here") is busy
+
+def test_dynamic_membership():
+    '''
+    Nodes can join, leave and be resized on a live distributor
+    '''
+    def cluster():
+        return lighthouse.Node.from_list([
+            {
+                "name": "node-%d" % i,
+                "resources": {
+                    "cpu": 4
+                }
+            } for i in range(3)])
+    load = lambda name, cpu: lighthouse.Workload(name, {"cpu": cpu})
+    for distor in distributors(cluster, {"cpu": 1}):
+        assert distor.attempt_assign_loads([load("big", 6)]) == {"big": None}
+
+        big_node = lighthouse.Node("node-big", {"cpu": 8})
+        distor.add_node(big_node)
+        with pytest.raises(lighthouse.LighthouseException):
+            distor.add_node(lighthouse.Node("node-big", {"cpu": 8}))
+        assert distor.get_node("node-big") is big_node
+        assert distor.attempt_assign_loads([load("big", 6)]) == {
+            "big": "node-big"
+        }
+
+        with pytest.raises(lighthouse.LighthouseException):
+            distor.remove_node("node-big")
+        orphans = distor.remove_node("node-big", drain=True)
+        assert orphans == [load("big", 6)]
+        assert big_node.resources == {"cpu": 8}
+        assert distor.get_node("node-big") is None
+        assert distor.locate("big") is None
+        assert distor.remove_node("node-big") is None
+        assert len(list(distor._all_nodes())) == 3
+        big_node.detach_all()
+
+        distor.update_resources("node-1", {"cpu": 10})
+        assert distor.attempt_assign_loads([load("big", 6)]) == {
+            "big": "node-1"
+        }
+        assert distor.remove_node("node-0") == []
+        assert [n.name for n in distor._all_nodes()] in (
+            ["node-1", "node-2"], ["node-2", "node-1"])
+
+def test_roundrobin_membership_cursor():
+    nodes = lighthouse.Node.from_list([
+        {
+            "name": "node-%d" % i,
+            "resources": {
+                "slot": 5
+            }
+        } for i in range(4)])
+    loads = [lighthouse.Workload("load-%d" % i, {"slot": 1})
+             for i in range(6)]
+    rr = lighthouse.RoundRobinDistributor.from_list(nodes)
+    rr.attempt_assign_loads(loads[:2])
+    assert rr.next == 2
+    rr.remove_node("node-0", drain=True)
+    assert rr.next == 1
+    assert rr.attempt_assign_loads(loads[2:3]) == {"load-2": "node-2"}
+    rr.remove_node("node-3")
+    assert rr.next == 0
+    assert rr.attempt_assign_loads(loads[3:4]) == {"load-3": "node-1"}
+
+def test_assign_stream(tmpdir):
+    '''
+    Loads can be streamed through a distributor from a file, with bounded
+    buffering
+    '''
+    import json
+    feed = tmpdir.join("feed.jsonl")
+    feed.write("\n".join(json.dumps({
+        "name": "load-%d" % i,
+        "requirements": {
+            "cpu": 1 + i % 3
+        }
+    }) for i in range(12)))
+    read = []
+
+    def workloads():
+        with open(str(feed)) as f:
+            for line in f:
+                w = lighthouse.Workload.from_dict(json.loads(line))
+                read.append(w.name)
+                yield w
+
+    def make_nodes():
+        return lighthouse.Node.from_list([
+            {
+                "name": "node-%d" % i,
+                "resources": {
+                    "cpu": 6 + i
+                }
+            } for i in range(2)])
+
+    pr = lighthouse.PrioritizedDistributor.from_list(make_nodes())
+    stream = pr.assign_stream(workloads())
+    assert next(stream) == ("load-0", "node-0")
+    assert read == ["load-0"]
+    rest = list(stream)
+    assert rest[0] == ("load-1", "node-0")
+    assert rest[-1] == ("load-11", None)
+
+    bp = lighthouse.BinPackDistributor.from_list({"cpu": 1}, make_nodes())
+    stream = bp.assign_stream(workloads(), window=4)
+    first = [next(stream) for i in range(4)]
+    assert len(read) == 12 + 4
+    assert [name for name, node in first] == \
+        ["load-2", "load-1", "load-0", "load-3"]
+    assert dict(first) == lighthouse.BinPackDistributor.from_list(
+        {"cpu": 1}, make_nodes()).attempt_assign_loads(
+            lighthouse.Workload.from_list(
+                [json.loads(line) for line in feed.read().split("\n")[:4]]))
+    assert len(list(stream)) == 8
+
+def test_locking_stress():
+    '''
+    Threads placing and releasing workloads at once on a distributor with
+    locking never over-commit a node, and leave its indexes consistent
+    '''
+    def cluster():
+        return lighthouse.Node.from_list([
+            {
+                "name": "node-%d" % i,
+                "resources": {
+                    "cpu": 10,
+                    "mem": 10 + i
+                }
+            } for i in range(6)])
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for distor in distributors(cluster, {"cpu": 1, "mem": 0.5},
+                                   DISTRIBUTORS[:3], capacity_index=True):
+            nodes = list(distor._all_nodes())
+            totals = dict((n.name, dict(n.resources)) for n in nodes)
+            distor.use_locking()
+            overcommitted = []
+
+            def worker(seed):
+                rng = random.Random(seed)
+                mine = []
+                for i in range(300):
+                    if mine and rng.random() < 0.4:
+                        name = mine.pop(rng.randrange(len(mine)))
+                        assert distor.release([name])[name] is not None
+                        continue
+                    load = lighthouse.Workload(
+                        "load-%d-%d" % (seed, i),
+                        {"cpu": rng.randint(1, 4), "mem": rng.randint(1, 4)})
+                    placed = distor.attempt_assign_loads([load])[load.name]
+                    if placed is not None:
+                        mine.append(load.name)
+                        node = distor.get_node(placed)
+                        if min(node.resources.values()) < 0:
+                            overcommitted.append(placed)
+
+            threads = [threading.Thread(target=worker, args=(seed,))
+                       for seed in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            assert overcommitted == []
+            placed = 0
+            for n in nodes:
+                for k, total in totals[n.name].items():
+                    used = sum(w.requirements[k]
+                               for w in n.assigned_workloads.values())
+                    assert n.resources[k] == total - used
+                    assert n.resources[k] >= 0
+                for name in n.assigned_workloads:
+                    assert distor.locate(name) is n
+                placed += len(n.assigned_workloads)
+            assert len(distor.placements) == placed
+            if isinstance(distor, lighthouse.BinPackDistributor):
+                for n in nodes:
+                    assert distor.scores[n.name] == \
+                        distor.rubric.score(n.resources)
+                    assert dict(distor.capacities.indexed[n.name]) == \
+                        dict(n.resources)
+    finally:
+        sys.setswitchinterval(interval)
+
+def test_transaction_rollback():
+    '''
+    Rolling back a transaction restores nodes and indexes exactly, undoing
+    only the changes made since it began
+    '''
+    def cluster():
+        return lighthouse.Node.from_list([
+            {
+                "name": "node-%d" % i,
+                "resources": {
+                    "cpu": 4.1 + i,
+                    "mem": 8
+                }
+            } for i in range(3)])
+
+    def state(distor):
+        nodes = sorted(distor._all_nodes(), key=lambda n: n.name)
+        return (repr(nodes), sorted(distor.placements),
+                dict((g, set(ns)) for g, ns in distor.aversions.groups.items()),
+                getattr(distor, "next", None),
+                list(getattr(distor, "scores", {}).items()),
+                list(getattr(distor, "nodes", {})))
+
+    loads = [lighthouse.Workload("load-%d" % i, {"cpu": 0.7, "mem": 1},
+                                 aversion_groups=set(["pair"]))
+             for i in range(6)]
+    for distor in distributors(cluster, {"cpu": 0.3, "mem": 0.1},
+                               DISTRIBUTORS[:3], capacity_index=True):
+        distor.attempt_assign_loads(loads[:2])
+        before = state(distor)
+        with distor.transaction() as tx:
+            distor.attempt_assign_loads(loads[2:])
+            distor.release(["load-0", "load-3"])
+            distor.update_resources("node-1", {"cpu": 1, "gpu": 2})
+            with distor.transaction() as inner:
+                distor.release(["load-4"])
+                inner.rollback()
+            assert distor.locate("load-4") is not None
+            tx.rollback()
+        assert state(distor) == before
+        assert "gpu" not in distor.get_node("node-1").resources
+
+        with pytest.raises(lighthouse.LighthouseException):
+            with distor.transaction():
+                distor.release(["load-1"])
+                raise lighthouse.LighthouseException("abandon")
+        assert state(distor) == before
+
+        with distor.transaction():
+            distor.release(["load-1"])
+            with pytest.raises(lighthouse.LighthouseException):
+                distor.remove_node("node-2")
+        assert distor.locate("load-1") is None
+        assert distor._undo is None
+
+def test_node_copy_and_pickle():
+    '''
+    Copied and unpickled nodes are detached from the original's
+    distributor; a copied or unpickled distributor follows its own nodes
+    '''
+    def cluster():
+        return [lighthouse.Node("node-%d" % i, {"cpu": 4}) for i in range(3)]
+    nodes = cluster()
+    distor = lighthouse.BinPackDistributor.from_list(
+        {"cpu": 1}, nodes).use_locking()
+    before = (list(distor.nodes.items()), dict(distor.scores))
+    for copied in (copy.deepcopy(nodes), pickle.loads(pickle.dumps(nodes))):
+        assert copied == cluster()
+        assert copied[0]._mutex is lighthouse._UNLOCKED
+        assert copied[0].attempt_attach(lighthouse.Workload("x", {"cpu": 3}))
+        copied[1].detach_all()
+        assert (list(distor.nodes.items()), dict(distor.scores)) == before
+        assert distor.placements == {}
+
+    distor.attempt_assign_loads([lighthouse.Workload("y", {"cpu": 1})])
+    for copied in (copy.deepcopy(distor), pickle.loads(pickle.dumps(distor))):
+        assert copied._mutex is not lighthouse._UNLOCKED
+        assert copied.attempt_assign_loads(
+            [lighthouse.Workload("z", {"cpu": 4})]) == {"z": "node-1"}
+        assert copied.scores == {"node-0": 3, "node-1": 0, "node-2": 4}
+        copied.get_node("node-0").detach_all()
+        assert copied.scores["node-0"] == 4
+        assert sorted(copied.placements) == ["z"]
+        assert distor.scores == {"node-0": 3, "node-1": 4, "node-2": 4}
+        assert sorted(distor.placements) == ["y"]
+
+def test_transaction_rollback_wards():
+    '''
+    Rolling back releases which took a resource out of the negative puts
+    the ward back, so loads not immune to it are refused again
+    '''
+    node = lighthouse.Node("node", {"cpu": 4, "mem": 5, "gpu": 3})
+    distor = lighthouse.PrioritizedDistributor([node])
+    assert distor.attempt_assign_loads([
+        lighthouse.Workload("a", {"mem": 2, "gpu": 2}),
+        lighthouse.Workload("b", {"cpu": 2, "mem": 5}, set(["mem"]))
+    ]) == {"a": "node", "b": "node"}
+    wards = node._wards
+    assert wards
+    with distor.transaction() as tx:
+        distor.release(["a", "b"])
+        assert node._wards == 0
+        tx.rollback()
+    assert node.resources == {"cpu": 2, "mem": -2, "gpu": 1}
+    assert node._wards == wards
+    assert distor.attempt_assign_loads([
+        lighthouse.Workload("c", {"cpu": 1})
+    ]) == {"c": None}
+
+def test_gang_placement():
+    '''
+    A gang is placed whole, as its loads would be one after the other, or
+    not at all, leaving the nodes untouched
+    '''
+    def cluster():
+        return lighthouse.Node.from_list([
+            {
+                "name": "node-%d" % i,
+                "resources": {
+                    "cpu": 4 + i
+                }
+            } for i in range(3)])
+
+    def gang(size, cpu):
+        return [lighthouse.Workload("rank-%d" % i, {"cpu": cpu},
+                                    aversion_groups=set(["job"]))
+                for i in range(size)]
+
+    for make in [lighthouse.PrioritizedDistributor.from_list,
+                 lighthouse.RoundRobinDistributor.from_list]:
+        distor = make(cluster())
+        distor.attempt_assign_loads([lighthouse.Workload("other", {"cpu": 3})])
+        expected = make(cluster())
+        expected.attempt_assign_loads(
+            [lighthouse.Workload("other", {"cpu": 3})])
+        assert distor.attempt_assign_gang(gang(4, 2)) == \
+            expected.attempt_assign_loads(gang(4, 2))
+        assert repr(distor.nodes) == repr(expected.nodes)
+
+    bp = lighthouse.BinPackDistributor.from_list({"cpu": 1}, cluster())
+    placed = bp.attempt_assign_gang(gang(3, 2))
+    assert sorted(placed.values()) == ["node-0", "node-1", "node-2"]
+    for n in bp._all_nodes():
+        assert bp.scores[n.name] == n.resources["cpu"]
+
+    for make in [lighthouse.PrioritizedDistributor.from_list,
+                 lighthouse.RoundRobinDistributor.from_list,
+                 lambda ns: lighthouse.BinPackDistributor.from_list(
+                     {"cpu": 1}, ns).use_matrix()]:
+        distor = make(cluster())
+        distor.attempt_assign_loads([lighthouse.Workload("other", {"cpu": 3})])
+        before = repr(list(distor._all_nodes()))
+        cursor = getattr(distor, "next", None)
+        assert distor.attempt_assign_gang(gang(5, 3)) == \
+            dict(("rank-%d" % i, None) for i in range(5))
+        assert repr(list(distor._all_nodes())) == before
+        assert getattr(distor, "next", None) == cursor
+        assert sorted(distor.placements) == ["other"]
+
+def test_binpack_gang():
+    '''
+    BinPack plans a gang best fit, scoring nodes with the gang's loads
+    planned on them, just as it places the loads one after the other
+    '''
+    def cluster():
+        return [lighthouse.Node("x", {"cpu": 6}),
+                lighthouse.Node("z", {"cpu": 4})]
+    gang = [lighthouse.Workload("a", {"cpu": 5}),
+            lighthouse.Workload("b", {"cpu": 1})]
+    for distor in distributors(cluster, {"cpu": 1}, DISTRIBUTORS[2:]):
+        assert distor.attempt_assign_gang(gang) == {"a": "x", "b": "x"}
+
+    def mixed():
+        rng = random.Random(3)
+        return [lighthouse.Node("node-%d" % i, {
+            "cpu": rng.randint(2, 12),
+            "mem": rng.choice([2, 4.5, 8, 16.25])
+        }) for i in range(12)]
+    rng = random.Random(8)
+    gangs = [[lighthouse.Workload("load-%d-%d" % (g, i), {
+        "cpu": rng.randint(1, 4),
+        "mem": rng.choice([0.5, 1, 2.25])
+    }) for i in range(rng.randint(2, 6))] for g in range(10)]
+    for rubric in ({"cpu": 1, "mem": 2}, {"cpu": 0.3, "mem": 0.1}):
+        for indexed in (False, True):
+            for distor, expected in zip(
+                    distributors(mixed, rubric, DISTRIBUTORS[2:], indexed),
+                    distributors(mixed, rubric, DISTRIBUTORS[2:], indexed)):
+                for loads in gangs:
+                    placed = expected.attempt_assign_loads(loads)
+                    if None in placed.values():
+                        expected.release(placed)
+                        placed = dict((l.name, None) for l in loads)
+                    assert distor.attempt_assign_gang(loads) == placed
+                assert list(distor.nodes.items()) == \
+                    list(expected.nodes.items())
+
+def test_workload_plan():
+    '''
+    A workload's compiled plan is reused until the workload changes,
+    however it is changed, and the workload keeps the caller's containers
+    '''
+    node = lighthouse.Node("node", {"cpu": 4, "gpu": 2, "dedicated": -1})
+    requirements = {"cpu": 2}
+    load = lighthouse.Workload("load", requirements, set())
+    assert load.requirements is requirements
+    assert node._fit(load) is None
+    plan = load._compiled()
+    assert load._compiled() is plan
+
+    load.immunities.add("dedicated")
+    assert node._fit(load) == {"cpu": 2}
+    load.requirements["gpu"] = 3
+    assert node._fit(load) is None
+    load.immunities |= set(["gpu"])
+    assert node._fit(load) == {"cpu": 2, "gpu": -1}
+    load.requirements = {"cpu": 5}
+    assert node._fit(load) is None
+    assert load._compiled() is not plan
+
+    assert load == lighthouse.Workload("load", {"cpu": 5},
+                                       set(["dedicated", "gpu"]))
+    assert repr(load.requirements) == "{'cpu': 5}"
+    bare = lighthouse.Workload("bare", {})
+    assert repr(bare) == repr({"name": "bare", "requirements": {},
+                               "immunities": set(),
+                               "aversion_groups": set()})
+    bare.immunities.add("dedicated")
+    assert lighthouse.Workload("b", {}).immunities == set()
+
+    other = lighthouse.Workload("other", {}, set(["dedicated"]), ["x"])
+    assert node.attempt_attach(other)
+    averse = lighthouse.Workload("averse", {}, aversion_groups=[])
+    assert not node.has_averse_loads(averse)
+    averse.aversion_groups.append("x")
+    assert node.has_averse_loads(averse)
+
+    # Other mappings are compared too, so they cannot over-commit a node
+    ordered = lighthouse.Workload("ordered", OrderedDict(cpu=1))
+    small = lighthouse.Node("small", {"cpu": 4})
+    assert small._fit(ordered) == {"cpu": 3}
+    ordered.requirements["cpu"] = 100
+    assert not small.attempt_attach(ordered)
+    assert small.resources == {"cpu": 4}
+
+def test_workload_plan_checked_once():
+    '''
+    A distributor checks a load's plan once however many nodes it tries
+    '''
+    checks = []
+
+    class CheckedWorkload(lighthouse.Workload):
+        def _compiled(self):
+            checks.append(self.name)
+            return super(CheckedWorkload, self)._compiled()
+
+    nodes = [lighthouse.Node("node-%d" % i, {"cpu": i}) for i in range(8)]
+    for distor in (lighthouse.PrioritizedDistributor(nodes),
+                   lighthouse.PrioritizedDistributor(nodes).use_locking()):
+        del checks[:]
+        load = CheckedWorkload("load", {"cpu": 7}, set(), set(["x"]))
+        assert distor.attempt_assign_loads([load]) == {"load": "node-7"}
+        assert checks == ["load"]
+        nodes[7].detach_all()
+
+def test_ward_bits():
+    '''
+    Nodes keep a bitmask of their negative resources up to date however
+    those resources change, and reject warded loads with it
+    '''
+    node = lighthouse.Node("node", {"cpu": 4, "scratch": 1})
+    distor = lighthouse.PrioritizedDistributor([node])
+    plain = lighthouse.Workload("plain", {"cpu": 1})
+    hog = lighthouse.Workload("hog", {"scratch": 3}, set(["scratch"]))
+    assert node._wards == 0
+
+    assert node.attempt_attach(hog)
+    assert node.resources["scratch"] == -2
+    assert node._wards != 0
+    assert not node.attempt_attach(plain)
+    assert node.detach("hog") is hog
+    assert node._wards == 0
+    assert node.attempt_attach(plain)
+
+    node.add_ward("dedicated")
+    assert node._fit(plain) is None
+    node.update_resources({"dedicated": 0})
+    assert node._fit(plain) == {"cpu": 2}
+
+    with distor.transaction() as tx:
+        distor.update_resources("node", {"cpu": -1})
+        assert node._fit(hog) is None
+        tx.rollback()
+    assert node._fit(hog) == {"scratch": -2}
+
+    node.attempt_attach(hog)
+    node.detach_all()
+    assert node._wards == 0
+    assert lighthouse.Node("warded", {"gpu": -float("inf")})._fit(plain) \
+        is None
+
+    flies = lighthouse.Node("flies", {"cpu": 4, "flies": -5})
+    swatter = lighthouse.Workload("swatter", {"flies": -5})
+    assert flies._fit(plain) is None
+    assert flies.attempt_attach(swatter)
+    assert flies._fit(plain) == {"cpu": 3}
+    flies.detach("swatter")
+    assert flies._fit(plain) is None
+
+
+def test_least_loaded():
+    '''
+    LeastLoaded places each load on the node with the smallest dominant
+    share which fits it, keeping shares up to date as loads come and go
+    '''
+    nodes = [lighthouse.Node("small", {"cpu": 4, "ram": 8}),
+             lighthouse.Node("big", {"cpu": 16, "ram": 64}),
+             lighthouse.Node("busy", {"cpu": 6, "ram": 14}, {
+                 "old": lighthouse.Workload("old", {"cpu": 2, "ram": 2})})]
+    distor = lighthouse.LeastLoadedDistributor.from_list(nodes)
+    assert distor.shares == {"small": 0, "big": 0, "busy": 0.25}
+
+    def job(i, cpu, ram):
+        return lighthouse.Workload("job-%d" % i, {"cpu": cpu, "ram": ram})
+    assert distor.attempt_assign_loads([job(0, 1, 1)]) == {"job-0": "big"}
+    assert distor.shares["big"] == 1 / 16.0
+    # Memory dominates on the big node once job-2 is on it
+    assert distor.attempt_assign_loads(
+        [job(1, 2, 2), job(2, 1, 40), job(3, 1, 1)]) == \
+        {"job-1": "small", "job-2": "big", "job-3": "busy"}
+    assert distor.shares["small"] == 0.5
+
+    distor.release(["job-2"])
+    assert distor.shares["big"] == 1 / 16.0
+    distor.update_resources("busy", {"cpu": 0})
+    assert distor.totals["busy"]["cpu"] == 3
+    assert distor.shares["busy"] == 1.0
+
+    # Only the named resources count towards a node's share
+    by_ram = lighthouse.LeastLoadedDistributor.from_list(
+        [lighthouse.Node("a", {"cpu": 4, "ram": 8}),
+         lighthouse.Node("b", {"cpu": 4, "ram": 8})], ["ram"])
+    assert by_ram.attempt_assign_loads([job(4, 4, 1), job(5, 0, 2)]) == \
+        {"job-4": "a", "job-5": "b"}
+
+    # Spread placement agrees with picking the least loaded node afresh
+    rng = random.Random(7)
+    cluster = [lighthouse.Node("n-%d" % i, {"cpu": rng.randint(4, 32),
+                                            "ram": rng.randint(8, 128)})
+               for i in range(20)]
+    distor = lighthouse.LeastLoadedDistributor(cluster)
+    for i in range(200):
+        load = job(i, rng.randint(1, 4), rng.randint(1, 16))
+        fits = [n for n in cluster if n._fit(load) is not None]
+        expected = min(fits, key=lambda n: (distor._share(n), n.name)) \
+            if fits else None
+        assert distor.attempt_assign_loads([load])[load.name] == \
+            (expected.name if expected else None)
+        if i % 3 == 0:
+            distor.release(["job-%d" % rng.randint(0, i)])
+    for n in cluster:
+        assert distor.shares[n.name] == distor._share(n)
+
+
+def test_least_loaded_gang():
+    '''
+    A gang on LeastLoaded counts its own planned loads towards node shares,
+    spreading as attempt_assign_loads would
+    '''
+    def cluster():
+        return [lighthouse.Node("A", {"cpu": 10, "x": 1}),
+                lighthouse.Node("B", {"cpu": 10})]
+
+    def gang():
+        return [lighthouse.Workload("l1", {"cpu": 5, "x": 1}),
+                lighthouse.Workload("l2", {"cpu": 4}),
+                lighthouse.Workload("l3", {"cpu": 1})]
+    expected = lighthouse.LeastLoadedDistributor(
+        cluster()).attempt_assign_loads(gang())
+    assert expected == {"l1": "A", "l2": "B", "l3": "B"}
+    distor = lighthouse.LeastLoadedDistributor(cluster())
+    assert distor.attempt_assign_gang(gang()) == expected
+    for n in distor.nodes.values():
+        assert distor.shares[n.name] == distor._share(n)
+
+
+def test_roundrobin_headroom_index(visited):
+    '''
+    RoundRobin with a headroom index places exactly as without one, but
+    never visits nodes with none left of what a load needs
+    '''
+    def cluster():
+        rng = random.Random(11)
+        return [VisitedNode("node-%d" % i, {
+            "cpu": rng.randint(0, 6),
+            "gpu": rng.choice([0, 0, 0, 1]),
+            "spiders": 0 if i % 5 else -float("inf")
+        }) for i in range(30)]
+    plain = lighthouse.RoundRobinDistributor(cluster())
+    indexed = lighthouse.RoundRobinDistributor(cluster()).use_headroom_index()
+
+    rng = random.Random(5)
+    visits = {plain: 0, indexed: 0}
+    for i in range(300):
+        load = lighthouse.Workload(
+            "load-%d" % i,
+            {"cpu": rng.randint(1, 2), "gpu": rng.choice([0, 0, 1])},
+            set(["spiders"]) if i % 4 == 0 else set(),
+            set(["group-%d" % (i % 3)]))
+        seen = []
+        for distor in (plain, indexed):
+            del visited[:]
+            placed = distor.attempt_assign_loads([load])
+            assert distor.next == plain.next
+            seen.append(set(visited))
+            visits[distor] += len(visited)
+        assert placed == {load.name: plain.locate(load.name).name
+                          if plain.locate(load.name) else None}
+        assert seen[1] <= seen[0]
+        if i % 7 == 0:
+            names = ["load-%d" % rng.randint(0, i) for j in range(3)]
+            assert plain.release(names) == indexed.release(names)
+        if i == 150:
+            for distor in (plain, indexed):
+                distor.remove_node("node-3", drain=True)
+                distor.update_resources("node-4", {"cpu": 9})
+                distor.add_node(VisitedNode("node-30", {"cpu": 4, "gpu": 1}))
+    assert repr(plain.nodes) == repr(indexed.nodes)
+    assert visits[indexed] < visits[plain] / 2
+
+def test_roundrobin_headroom_removal():
+    '''
+    Removing nodes takes them out of the headroom index without rebuilding
+    it, and the rotation carries on as it would without the index
+    '''
+    def cluster():
+        return [lighthouse.Node("node-%d" % i, {"cpu": 1 + i % 3})
+                for i in range(12)]
+    plain = lighthouse.RoundRobinDistributor(cluster())
+    indexed = lighthouse.RoundRobinDistributor(cluster()).use_headroom_index()
+
+    def rebuild(nodes):
+        raise AssertionError("the headroom index was rebuilt")
+    indexed.headroom.rebuild = rebuild
+
+    loads = [lighthouse.Workload("load-%d" % i, {"cpu": 1 + i % 2})
+             for i in range(24)]
+    removed = ["node-0", "node-6", "node-11", "node-3", "node-7"]
+    for i, load in enumerate(loads):
+        assert indexed.attempt_assign_loads([load]) == \
+            plain.attempt_assign_loads([load])
+        if i % 4 == 3 and removed:
+            name = removed.pop(0)
+            assert indexed.remove_node(name, drain=True) == \
+                plain.remove_node(name, drain=True)
+            assert indexed.next == plain.next
+    indexed.add_node(lighthouse.Node("node-12", {"cpu": 4}))
+    plain.add_node(lighthouse.Node("node-12", {"cpu": 4}))
+    more = [lighthouse.Workload("more-%d" % i, {"cpu": 1}) for i in range(4)]
+    assert indexed.attempt_assign_loads(more) == \
+        plain.attempt_assign_loads(more)
+    assert repr(indexed.nodes) == repr(plain.nodes)
+    assert "node-0" not in indexed.headroom.at
+    headroom = indexed.headroom
+    assert [headroom.nodes[headroom.at[n.name]] for n in indexed.nodes] == \
+        indexed.nodes
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2018 the pylighthouse authors, see the AUTHORS.rst file.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+'''
+Tests for `pylighthouse.snapshot`.
+'''
+
+import random
+
+import pytest
+
+import pylighthouse.pylighthouse as lighthouse
+from pylighthouse.compact import CompactNode, CompactWorkload
+
+
+def cluster(make_node):
+    return [make_node("node-%d" % i, {
+        "cpu": 8 + i,
+        "mem": 16.5,
+        "spiders": -float("inf") if i == 1 else 0
+    }) for i in range(4)]
+
+
+def workloads(make_load, first, count):
+    return [make_load("load-%d" % i, {"cpu": 1 + i % 3, "mem": 0.25},
+                      set(["spiders"]) if i % 2 else set(),
+                      set(["group-%d" % (i % 3)]))
+            for i in range(first, first + count)]
+
+
+def state(distor):
+    return (type(distor), repr(list(distor._all_nodes())),
+            dict((k, n.name) for k, n in distor.placements.items()),
+            dict((g, set(ns)) for g, ns in distor.aversions.groups.items()),
+            getattr(distor, "next", None),
+            sorted(getattr(distor, "scores", {}).items()),
+            sorted(getattr(distor, "shares", {}).items()),
+            getattr(distor, "capacities", None) is not None,
+            getattr(distor, "headroom", None) is not None)
+
+
+@pytest.mark.parametrize("make", [
+    lighthouse.PrioritizedDistributor,
+    lighthouse.RoundRobinDistributor,
+    lambda ns: lighthouse.RoundRobinDistributor(ns).use_headroom_index(),
+    lambda ns: lighthouse.BinPackDistributor.from_list(
+        {"cpu": 1, "mem": 0.1}, ns).use_capacity_index(),
+    lambda ns: lighthouse.VectorBinPackDistributor.from_list(
+        {"cpu": 1, "mem": 0.1}, ns),
+    lambda ns: lighthouse.LeastLoadedDistributor.from_list(ns, ["cpu"])
+])
+@pytest.mark.parametrize("kinds", [
+    (lighthouse.Node, lighthouse.Workload),
+    (CompactNode, CompactWorkload)
+])
+def test_snapshot_restore(tmpdir, make, kinds):
+    make_node, make_load = kinds
+    distor = make(cluster(make_node))
+    distor.attempt_assign_loads(workloads(make_load, 0, 12))
+    distor.release(["load-4"])
+    path = str(tmpdir.join("cluster.snapshot"))
+    distor.snapshot(path)
+    restored = lighthouse.Distributor.restore(path)
+    assert state(restored) == state(distor)
+    assert isinstance(next(iter(restored._all_nodes())), make_node)
+
+    more = workloads(make_load, 12, 12)
+    assert restored.attempt_assign_loads(more) == \
+        distor.attempt_assign_loads(workloads(make_load, 12, 12))
+    assert state(restored) == state(distor)
+
+
+def test_snapshot_errors(tmpdir):
+    path = tmpdir.join("cluster.snapshot")
+    distor = lighthouse.PrioritizedDistributor(cluster(lighthouse.Node))
+    distor.snapshot(str(path))
+    data = path.read_binary()
+    path.write_binary(data[:8] + b"\x09" + data[9:])
+    with pytest.raises(lighthouse.LighthouseException):
+        lighthouse.Distributor.restore(str(path))
+    path.write_binary(b"not a snapshot" + data)
+    with pytest.raises(lighthouse.LighthouseException):
+        lighthouse.Distributor.restore(str(path))
+
+    empty = lighthouse.RoundRobinDistributor([])
+    empty.snapshot(str(path))
+    assert lighthouse.Distributor.restore(str(path)).nodes == []
+
+
+@pytest.mark.parametrize("kinds", [
+    (lighthouse.Node, lighthouse.Workload),
+    (CompactNode, CompactWorkload)
+])
+def test_snapshot_least_loaded_order(tmpdir, kinds):
+    '''
+    A restored LeastLoaded distributor keeps the capacities and shares it
+    had, rather than measuring them again from what is left, so it offers
+    nodes in exactly the same order
+    '''
+    make_node, make_load = kinds
+    rng = random.Random(4)
+    distor = lighthouse.LeastLoadedDistributor([make_node("node-%d" % i, {
+        "cpu": 7.3 + i * 0.1,
+        "mem": 3.1
+    }) for i in range(8)])
+    for i in range(400):
+        distor.attempt_assign_loads([make_load("load-%d" % i, {
+            "cpu": rng.choice([0.1, 0.7, 1.3]),
+            "mem": rng.choice([0.2, 0.3])
+        })])
+        if i % 3:
+            distor.release(["load-%d" % rng.randint(0, i)])
+    path = str(tmpdir.join("cluster.snapshot"))
+    distor.snapshot(path)
+    restored = lighthouse.Distributor.restore(path)
+    assert restored.totals == distor.totals
+    assert restored.shares == distor.shares
+    load = make_load("probe", {"cpu": 0.1})
+    assert [n.name for n in restored._candidates(load)] == \
+        [n.name for n in distor._candidates(load)]